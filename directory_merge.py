@@ -1,6 +1,14 @@
 from . import files
+from . import file_counting as fc
 import os
+import json
+import time
+import shutil
+import inspect
+import tempfile
 from enum import Enum
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from .logger import Logger, LoggerInvalidUsageExceptions
 
 
@@ -24,11 +32,18 @@ class Command:
     def get_result(self):
         return self.__result
 
+    # Used when the command was already run (e.g. by an interrupted merge recorded in a journal)
+    def set_result(self, result):
+        self.__result = result
+
+    def get_operation(self):
+        return self.__operation
+
     def get_operation_name(self):
         return self.__operation.__name__
 
     def get_args_copy(self):
-        return self.__args.copy()
+        return tuple(self.__args)
 
     def get_kwargs_copy(self):
         return self.__kwargs.copy()
@@ -47,6 +62,18 @@ class CommandCode(Enum):
     NEWEST_FROM_D2 = 4
     MAKE_DIR = 5
     FILE_DIR_MATCH_CONFLICT = 6
+    MOVE_WITHIN_DEST = 7
+    LINK_WITHIN_DEST = 8
+    LINK_UNCHANGED = 9
+    NEW_FROM_DN = 10
+    NEWEST_FROM_DN = 11
+
+
+MergeBenchmark = namedtuple("MergeBenchmark", ["directories", "entries", "chained_seconds", "merge_many_seconds", "speedup"])
+
+
+# Files whose sizes match and whose modification times are within this many seconds may be renames of each other
+RENAME_MTIME_TOLERANCE = 1
 
 
 class FileItem:
@@ -87,6 +114,114 @@ class FileItem:
         return self.get_path()
 
 
+# Append-only JSON lines record of a merge's plan and the result of each command run
+# Lets an interrupted merge resume without searching the directories again or redoing finished commands
+class MergeJournal:
+
+    def __init__(self, filename, logger=None):
+        self.filename = filename
+        self.logger = logger
+        self.__file = None
+
+    # (settings, [(code, args, kwargs)], {command index: result}) of an unfinished merge (None if there isn't one)
+    def load(self):
+        if not files.target_exists(self.filename):
+            return None
+        header = None
+        plan = []
+        results = {}
+        try:
+            with open(self.filename, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError as e:
+                        # Most likely a line cut off by the interruption
+                        continue
+                    kind = entry.get("kind")
+                    if kind == "plan":
+                        header = entry
+                    elif kind == "command":
+                        plan.append((CommandCode(entry["code"]), entry["args"], entry["kwargs"]))
+                    elif kind == "result":
+                        results[entry["index"]] = entry["result"]
+                    elif kind == "complete":
+                        return None
+        except (OSError, KeyError) as e:
+            Logger.log(f"Unable to read journal \"{self.filename}\": {str(e)}", self.logger, "general")
+            return None
+        if header is None or len(plan) != header["count"]:
+            return None
+        return header["settings"], plan, results
+
+    def start(self, settings, commands):
+        self.close()
+        self.__file = open(self.filename, "w")
+        self.__write({"kind": "plan", "settings": settings, "count": len(commands)})
+        for command in commands:
+            self.__write({"kind": "command", "code": command.get_code().value, "args": list(command.get_args_copy()), "kwargs": command.get_kwargs_copy()})
+        self.__sync()
+
+    def resume(self):
+        self.close()
+        self.__file = open(self.filename, "a+")
+        # Finish off a line cut short by the interruption so the next entry starts on its own line
+        if self.__file.tell() > 0:
+            self.__file.seek(self.__file.tell() - 1)
+            last = self.__file.read(1)
+            if last != "\n":
+                self.__file.write("\n")
+
+    def record(self, index, result):
+        if not isinstance(result, (bool, int, float, str, type(None))):
+            result = str(result)
+        self.__write({"kind": "result", "index": index, "result": result})
+        self.__sync()
+
+    def finish(self):
+        self.__write({"kind": "complete"})
+        self.__sync()
+        self.close()
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def __write(self, entry):
+        self.__file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def __sync(self):
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+
+
+# Run the commands in order, recording each result in the journal (if one is given)
+# results: results of commands that have already been run (by index), which are skipped
+def run_commands(commands, logger=None, journal=None, results=None):
+    results = {} if results is None else results
+    for i, command in enumerate(commands):
+        # A result of False is a failure, so the command is tried again
+        if i in results and results[i] is not False:
+            command.set_result(results[i])
+            Logger.log(f"Skipping ({i + 1}/{len(commands)}): {command}", logger, "general")
+            continue
+        Logger.log(f"Executing ({i + 1}/{len(commands)}): {command}", logger, "general")
+        command.do(logger=logger)
+        Logger.log(f"Result: {command.get_result()}", logger, "general")
+        if journal is not None:
+            journal.record(i, command.get_result())
+    if journal is not None:
+        # The journal is left unfinished while any command failed so the next run tries them again
+        num_failed = len([x for x in commands if x.get_result() is False])
+        if num_failed == 0:
+            journal.finish()
+        else:
+            Logger.log(f"{num_failed} of {len(commands)} commands failed (they will be retried when resumed)", logger, "general")
+            journal.close()
+    return commands
+
+
 def __newer_file(f1, f2):
     if files.get_timestamp(f1.get_path()) > files.get_timestamp(f2.get_path()):
         return f1
@@ -102,19 +237,141 @@ def create_logger(show_general=True, show_search=True, show_copy=True, show_conf
     )
 
 
-def __copy(source, destination, logger=None):
+# files.copy only gets the "copy" log function, so its span is recorded here (where the Logger is available)
+def __copy(source, destination, logger=None, throttle=None):
     logger_function = None if logger is None else logger.copy
-    return files.copy(source, destination, 1, logger=logger_function)
+    with Logger.time_span("files.copy", logger):
+        return files.copy(source, destination, 1, logger=logger_function, throttle=throttle)
 
 
-def __create_dir_and_copy(source, destination, logger=None):
+def __create_dir_and_copy(source, destination, logger=None, throttle=None):
     logger_function = None if logger is None else logger.copy
     os.makedirs(os.path.dirname(destination), exist_ok=True)
-    return files.copy(source, destination, 1, logger=logger_function)
-
+    with Logger.time_span("files.copy", logger):
+        return files.copy(source, destination, 1, logger=logger_function, throttle=throttle)
+
+
+# Give the throttle to operations that take one (others are left as they are)
+def __with_throttle(operation, throttle):
+    if throttle is None or "throttle" not in inspect.signature(operation).parameters:
+        return operation
+    def throttled(*args, **kwargs):
+        return operation(*args, **kwargs, throttle=throttle)
+    throttled.__name__ = operation.__name__
+    return throttled
+
+
+def __move(source, destination, logger=None):
+    # Already moved (e.g. by an interrupted run being resumed)
+    if not os.path.lexists(source) and os.path.lexists(destination):
+        return True
+    try:
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.replace(source, destination)
+        return True
+    except OSError as e:
+        Logger.log(f"Failed to move \"{source}\" to \"{destination}\": {str(e)}", logger, "copy")
+        return False
+
+
+# Hard link (falling back to a copy where links aren't possible, e.g. across file systems)
+def __link(source, destination, logger=None):
+    try:
+        # Already linked (e.g. by an interrupted run being resumed)
+        if os.path.exists(destination) and os.path.samefile(source, destination):
+            return True
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        os.link(source, destination)
+        return True
+    except OSError as e:
+        Logger.log(f"Unable to link \"{source}\" to \"{destination}\" (copying instead): {str(e)}", logger, "copy")
+        with Logger.time_span("files.copy", logger):
+            return files.copy_file(source, destination, None if logger is None else logger.copy)
+
+
+# Files under a directory (recursively) as (path, path relative to the directory)
+def __walk_files(directory):
+    for root, dirs, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            yield path, os.path.relpath(path, directory)
+
+
+# Split the copy of a new directory into a MAKE_DIR per directory and a copy per file (with the original code)
+def __expand_directory_copy(command, operations):
+    source, destination = command.get_args_copy()[:2]
+    commands = []
+    for root, dirs, filenames in os.walk(source):
+        relative = os.path.relpath(root, source)
+        destination_root = destination if relative == "." else FileItem.attach_paths(destination, relative)
+        commands.append(Command(CommandCode.MAKE_DIR, operations[CommandCode.MAKE_DIR], destination_root))
+        for filename in filenames:
+            commands.append(Command(command.get_code(), command.get_operation(), os.path.join(root, filename), FileItem.attach_paths(destination_root, filename)))
+    return commands
+
+
+# Replace copies of files new to directory1 with moves or links of matching files new to directory2
+# The directory2 files must be in the destination (at their path in directory2) by the time the commands run,
+# either because NEW_FROM_D2 commands copy them there or because the destination is directory2
+# mode: "link" keeps both names (as a merge normally would); "move" keeps only the name from directory1
+# operations: CommandCode -> operation (MAKE_DIR, MOVE_WITHIN_DEST and LINK_WITHIN_DEST are used)
+# Rename commands are put at the end so the files they relocate are in place first
+def detect_renames(commands, operations, mode="link", use_hash=False, logger=None):
+    candidates = {}  # size -> [(mtime, source, destination)]
+    for command in commands:
+        if command.get_code() != CommandCode.NEW_FROM_D2:
+            continue
+        source, destination = command.get_args_copy()[:2]
+        if os.path.isfile(source):
+            candidates.setdefault(files.get_file_size(source), []).append((files.get_timestamp(source), source, destination))
+        else:
+            for path, relative in __walk_files(source):
+                candidates.setdefault(files.get_file_size(path), []).append((files.get_timestamp(path), path, FileItem.attach_paths(destination, relative)))
+    if len(candidates) == 0:
+        return commands
 
+    # New directories from directory1 holding possible matches are copied file by file so the matches can be left out
+    expanded = []
+    for command in commands:
+        source = command.get_args_copy()[0] if command.get_code() == CommandCode.NEW_FROM_D1 else None
+        if source is not None and os.path.isdir(source) and any(files.get_file_size(x[0]) in candidates for x in __walk_files(source)):
+            expanded += __expand_directory_copy(command, operations)
+        else:
+            expanded.append(command)
+
+    hashes = {}
+    def get_hash(filename):
+        if filename not in hashes:
+            hashes[filename] = files.get_file_hash(filename)
+        return hashes[filename]
+
+    result = []
+    renames = []
+    for command in expanded:
+        if command.get_code() != CommandCode.NEW_FROM_D1 or not os.path.isfile(command.get_args_copy()[0]):
+            result.append(command)
+            continue
+        source, destination = command.get_args_copy()[:2]
+        options = candidates.get(files.get_file_size(source), [])
+        mtime = files.get_timestamp(source)
+        match = None
+        for option in options:
+            if abs(option[0] - mtime) <= RENAME_MTIME_TOLERANCE and (not use_hash or get_hash(option[1]) == get_hash(source)):
+                match = option
+                break
+        if match is None:
+            result.append(command)
+            continue
+        options.remove(match)
+        Logger.log(f"Rename detected: \"{match[1]}\" -> \"{source}\"", logger, "search")
+        code = CommandCode.MOVE_WITHIN_DEST if mode == "move" else CommandCode.LINK_WITHIN_DEST
+        renames.append(Command(code, operations[code], match[2], destination))
+    return result + renames
+
+
+# An existing directory isn't a failure (run_commands retries commands that return False)
 def __mk_dir(directory):
-    return files.create_directory(directory)
+    return files.create_directory(directory) or os.path.isdir(directory)
 
 
 def __warn(path1, path2, logger=None):
@@ -129,16 +386,17 @@ def __is_file(filename):
     return os.path.isfile(filename)
 
 
-def get_differences_local(directory1, directory2, destination, logger=None):
+def get_differences_local(directory1, directory2, destination, logger=None, throttle=None):
     return merge(directory1, directory2, destination,
                  ignore_commands=[CommandCode.NEWEST_FROM_D1, CommandCode.NEWEST_FROM_D2, CommandCode.MAKE_DIR],
                  copy_from_item1_op=__create_dir_and_copy,
                  copy_from_item2_op=__create_dir_and_copy,
-                 logger=logger)
+                 logger=logger,
+                 throttle=throttle)
 
 
-def merge_into_destination_local(directory, destination, logger=None):
-    return merge(directory, destination, destination, ignore_commands=[CommandCode.NEW_FROM_D2], logger=logger)
+def merge_into_destination_local(directory, destination, logger=None, throttle=None):
+    return merge(directory, destination, destination, ignore_commands=[CommandCode.NEW_FROM_D2], logger=logger, throttle=throttle)
 
 
 def merge(directory1, directory2, destination,
@@ -152,7 +410,13 @@ def merge(directory1, directory2, destination,
           warn_op=__warn,
           ignore_commands=None,
           execute_commands=True,
-          logger=None):
+          logger=None,
+          journal=None,
+          throttle=None,
+          rename_detection=None,
+          rename_use_hash=False,
+          move_op=__move,
+          link_op=__link):
 
     # --------------------------
     # Define recursive function
@@ -218,24 +482,304 @@ def merge(directory1, directory2, destination,
     if logger is not None:
         required_types = ["general", "copy", "conflict"]
         logger.has_all_types(required_types, do_exception=True)
-    Logger.log("Starting search...", logger, "general")
-    commands = __get_merge_commands_recursive(FileItem(directory1, ""), FileItem(directory2, ""), destination, [])
+
+    # files.IOThrottle shared by every copy the merge makes
+    copy_from_item1_op = __with_throttle(copy_from_item1_op, throttle)
+    copy_from_item2_op = __with_throttle(copy_from_item2_op, throttle)
+
+    # Used to rebuild the commands of a journaled plan
+    operations = {
+        CommandCode.NEW_FROM_D1: copy_from_item1_op,
+        CommandCode.NEW_FROM_D2: copy_from_item2_op,
+        CommandCode.NEWEST_FROM_D1: copy_from_item1_op,
+        CommandCode.NEWEST_FROM_D2: copy_from_item2_op,
+        CommandCode.MAKE_DIR: mk_dir_op,
+        CommandCode.FILE_DIR_MATCH_CONFLICT: warn_op,
+        CommandCode.MOVE_WITHIN_DEST: move_op,
+        CommandCode.LINK_WITHIN_DEST: link_op
+    }
+    ignore_commands = [] if ignore_commands is None else ignore_commands
+    settings = {
+        "directory1": directory1,
+        "directory2": directory2,
+        "destination": destination,
+        "ignore_commands": sorted(x.value for x in ignore_commands),
+        "rename_detection": rename_detection,
+        "rename_use_hash": rename_use_hash
+    }
+    merge_journal = None if journal is None else MergeJournal(journal, logger)
+    saved = None if merge_journal is None else merge_journal.load()
+    if saved is not None and saved[0] != settings:
+        Logger.log(f"Journal \"{journal}\" is for a different merge (starting over)", logger, "general")
+        saved = None
+
+    results = {}
+    if saved is not None:
+        results = saved[2]
+        commands = [Command(code, operations[code], *args, **kwargs) for code, args, kwargs in saved[1]]
+        Logger.log(f"Resuming from journal \"{journal}\" ({len(results)} of {len(commands)} commands already run)", logger, "general")
+    else:
+        Logger.log("Starting search...", logger, "general")
+        with Logger.time_span("directory_merge.search", logger):
+            commands = __get_merge_commands_recursive(FileItem(directory1, ""), FileItem(directory2, ""), destination, [])
+
+        # rename_detection: None, "link" or "move" (see detect_renames)
+        d2_in_destination = CommandCode.NEW_FROM_D2 not in ignore_commands or os.path.realpath(directory2) == os.path.realpath(destination)
+        if rename_detection is not None and CommandCode.NEW_FROM_D1 not in ignore_commands and d2_in_destination:
+            commands = detect_renames(commands, operations, rename_detection, rename_use_hash, logger)
+
+        # Remove ignored commands
+        num_all_commands = len(commands)
+        commands = [x for x in commands if x.get_code() not in ignore_commands]
+        num_valid_commands = len(commands)
+        if num_valid_commands != num_all_commands:
+            Logger.log(f"Ignoring {num_all_commands - num_valid_commands} of {num_all_commands} commands", logger, "general")
+
+    if not execute_commands:
+        return commands
+
     Logger.log("Starting command execution...", logger, "general")
-    
-    # Remove ignored commands
-    num_all_commands = len(commands)
+    if merge_journal is not None:
+        if saved is None:
+            # A directory copy cut off part way can't be resumed (its destination already exists),
+            # so new directories are copied file by file
+            expanded = []
+            for command in commands:
+                if command.get_code() in (CommandCode.NEW_FROM_D1, CommandCode.NEW_FROM_D2) and os.path.isdir(command.get_args_copy()[0]):
+                    expanded += __expand_directory_copy(command, operations)
+                else:
+                    expanded.append(command)
+            commands = expanded
+            merge_journal.start(settings, commands)
+        else:
+            merge_journal.resume()
+    with Logger.time_span("directory_merge.execute", logger):
+        run_commands(commands, logger, merge_journal, results)
+    if throttle is not None:
+        Logger.log(f"Throttled IO: {files.IOThrottle.format_stats(throttle.get_stats())}", logger, "general")
+    Logger.log("Complete", logger, "general")
+    return commands
+
+
+# Commands building snapshot (a new directory) from source, linking files unchanged since previous (None if there isn't one)
+# A file is unchanged if its size matches and its modification time is within modify_window seconds
+def get_snapshot_commands(source, previous, snapshot, modify_window=0, copy_op=__copy, link_op=__link, mk_dir_op=__mk_dir):
+    commands = []
+    for root, dirs, filenames in os.walk(source):
+        dirs.sort()
+        relative = os.path.relpath(root, source)
+        snapshot_root = snapshot if relative == "." else FileItem.attach_paths(snapshot, relative)
+        previous_root = None if previous is None else (previous if relative == "." else FileItem.attach_paths(previous, relative))
+        commands.append(Command(CommandCode.MAKE_DIR, mk_dir_op, snapshot_root))
+        for filename in sorted(filenames):
+            path = os.path.join(root, filename)
+            previous_path = None if previous_root is None else FileItem.attach_paths(previous_root, filename)
+            destination = FileItem.attach_paths(snapshot_root, filename)
+            if previous_path is not None and os.path.isfile(previous_path) and __is_unchanged(path, previous_path, modify_window):
+                commands.append(Command(CommandCode.LINK_UNCHANGED, link_op, previous_path, destination))
+            else:
+                commands.append(Command(CommandCode.NEW_FROM_D1, copy_op, path, destination))
+    return commands
+
+
+def __is_unchanged(path, previous_path, modify_window):
+    stat = os.stat(path)
+    previous_stat = os.stat(previous_path)
+    return stat.st_size == previous_stat.st_size and abs(stat.st_mtime - previous_stat.st_mtime) <= modify_window
+
+
+# Create the next numbered backup of the source directory in backup_dir (e.g. "data_3" after "data_2" for "data")
+# Files unchanged since the latest backup are hard linked to it rather than copied, so each snapshot only
+# costs the time and space of what changed (linked files share their contents, so backups must not be edited)
+# policy: file_counting.RetentionPolicy applied to the snapshots afterwards (None to keep all of them)
+# Returns the snapshot's path (None if the source or backup directory doesn't exist)
+def snapshot(source, backup_dir, modify_window=0, policy=None, journal=None, throttle=None, logger=None):
+    if not os.path.isdir(source):
+        Logger.log(f"Source directory \"{source}\" does not exist", logger, "general")
+        return None
+    source_name = files.path_to_leaf(source.rstrip("/"))
+    index = fc.BackupIndex.from_directory(source_name, backup_dir)
+    if index is None:
+        Logger.log(f"Backup directory \"{backup_dir}\" does not exist", logger, "general")
+        return None
+
+    operations = {
+        CommandCode.NEW_FROM_D1: __with_throttle(__copy, throttle),
+        CommandCode.LINK_UNCHANGED: __link,
+        CommandCode.MAKE_DIR: __mk_dir
+    }
+    # Reuse the plan (and snapshot name) of an interrupted snapshot of the same source
+    settings = {"snapshot": source, "backup_dir": backup_dir, "modify_window": modify_window}
+    merge_journal = None if journal is None else MergeJournal(journal, logger)
+    saved = None if merge_journal is None else merge_journal.load()
+    if saved is not None and saved[0].get("snapshot") == source and saved[0].get("backup_dir") == backup_dir:
+        snapshot_dir = saved[0]["destination"]
+        results = saved[2]
+        commands = [Command(code, operations[code], *args, **kwargs) for code, args, kwargs in saved[1]]
+        Logger.log(f"Resuming snapshot \"{snapshot_dir}\" from journal \"{journal}\"", logger, "general")
+    else:
+        names = index.get_relevant_backup_names(backup_dir)
+        snapshot_dir = names.next
+        results = {}
+        with Logger.time_span("directory_merge.snapshot_search", logger):
+            commands = get_snapshot_commands(
+                source, names.last, snapshot_dir, modify_window,
+                operations[CommandCode.NEW_FROM_D1], operations[CommandCode.LINK_UNCHANGED], operations[CommandCode.MAKE_DIR]
+            )
+        num_linked = len([x for x in commands if x.get_code() == CommandCode.LINK_UNCHANGED])
+        num_copied = len([x for x in commands if x.get_code() == CommandCode.NEW_FROM_D1])
+        Logger.log(f"Snapshot \"{snapshot_dir}\": linking {num_linked} unchanged files and copying {num_copied}", logger, "general")
+        if merge_journal is not None:
+            merge_journal.start(dict(settings, destination=snapshot_dir), commands)
+
+    if merge_journal is not None and saved is not None:
+        merge_journal.resume()
+    with Logger.time_span("directory_merge.snapshot", logger):
+        run_commands(commands, logger, merge_journal, results)
+    if policy is not None:
+        fc.enforce_retention(source_name, backup_dir, policy, logger=None if logger is None else logger.general)
+    return snapshot_dir
+
+
+# Every entry under a directory as relative path -> (is file, modification time)
+def __list_tree(directory):
+    entries = {}
+    pending = [("", directory)]
+    while len(pending) > 0:
+        relative, path = pending.pop()
+        with os.scandir(path) as it:
+            for entry in it:
+                entry_relative = entry.name if relative == "" else f"{relative}/{entry.name}"
+                is_file = not entry.is_dir()
+                entries[entry_relative] = (is_file, entry.stat().st_mtime)
+                if not is_file:
+                    pending.append((entry_relative, entry.path))
+    return entries
+
+
+# Plan merging any number of directories into destination in a single pass
+# Each path gets the newest of its versions (the later directory wins ties, as in merge)
+# A path that is a file in some directories and a directory in others is warned about and skipped (with its contents)
+def get_merge_many_commands(directories, destination, copy_op=__copy, mk_dir_op=__mk_dir, warn_op=__warn, max_workers=None):
+    # Directories are listed concurrently since listing is mostly waiting on the file system
+    with ThreadPoolExecutor(max_workers=max_workers or max(1, min(32, len(directories)))) as executor:
+        trees = list(executor.map(__list_tree, directories))
+
+    versions = {}  # relative path -> [(directory index, is file, modification time)]
+    for i, tree in enumerate(trees):
+        for relative, (is_file, mtime) in tree.items():
+            versions.setdefault(relative, []).append((i, is_file, mtime))
+
+    destination_real = os.path.realpath(destination)
+    commands = [Command(CommandCode.MAKE_DIR, mk_dir_op, destination)]
+    conflicts = set()
+    # Sorting by components puts every directory before its contents
+    for relative in sorted(versions, key=lambda x: x.split("/")):
+        parent = relative.rsplit("/", 1)[0] if "/" in relative else None
+        if parent in conflicts:
+            conflicts.add(relative)
+            continue
+        options = versions[relative]
+        target = FileItem.attach_paths(destination, relative)
+        kinds = {x[1] for x in options}
+        if len(kinds) > 1:
+            conflicts.add(relative)
+            paths = [FileItem.attach_paths(directories[x[0]], relative) for x in options]
+            commands.append(Command(CommandCode.FILE_DIR_MATCH_CONFLICT, warn_op, paths[0], paths[1]))
+            continue
+        if not options[0][1]:
+            commands.append(Command(CommandCode.MAKE_DIR, mk_dir_op, target))
+            continue
+        newest = options[0]
+        for option in options[1:]:
+            if option[2] >= newest[2]:
+                newest = option
+        source = FileItem.attach_paths(directories[newest[0]], relative)
+        # The newest version may already be the destination's (when the destination is one of the directories)
+        if os.path.realpath(directories[newest[0]]) == destination_real:
+            continue
+        code = CommandCode.NEW_FROM_DN if len(options) == 1 else CommandCode.NEWEST_FROM_DN
+        commands.append(Command(code, copy_op, source, target))
+    return commands
+
+
+# N-way equivalent of merge: every directory is searched once (concurrently) and a single plan is run
+def merge_many(directories, destination, ignore_commands=None, execute_commands=True, journal=None, throttle=None, max_workers=None, logger=None):
+    if logger is not None:
+        required_types = ["general", "copy", "conflict"]
+        logger.has_all_types(required_types, do_exception=True)
+
+    operations = {
+        CommandCode.NEW_FROM_DN: __with_throttle(__copy, throttle),
+        CommandCode.NEWEST_FROM_DN: __with_throttle(__copy, throttle),
+        CommandCode.MAKE_DIR: __mk_dir,
+        CommandCode.FILE_DIR_MATCH_CONFLICT: __warn
+    }
     ignore_commands = [] if ignore_commands is None else ignore_commands
-    commands = [x for x in commands if x.get_code() not in ignore_commands]
-    num_valid_commands = len(commands)
-    if num_valid_commands != num_all_commands:
-        Logger.log(f"Ignoring {num_all_commands - num_valid_commands} of {num_all_commands} commands", logger, "general")
+    settings = {
+        "directories": list(directories),
+        "destination": destination,
+        "ignore_commands": sorted(x.value for x in ignore_commands)
+    }
+    merge_journal = None if journal is None else MergeJournal(journal, logger)
+    saved = None if merge_journal is None else merge_journal.load()
+    if saved is not None and saved[0] != settings:
+        Logger.log(f"Journal \"{journal}\" is for a different merge (starting over)", logger, "general")
+        saved = None
+
+    results = {}
+    if saved is not None:
+        results = saved[2]
+        commands = [Command(code, operations[code], *args, **kwargs) for code, args, kwargs in saved[1]]
+        Logger.log(f"Resuming from journal \"{journal}\" ({len(results)} of {len(commands)} commands already run)", logger, "general")
+    else:
+        Logger.log(f"Searching {len(directories)} directories...", logger, "general")
+        with Logger.time_span("directory_merge.merge_many_search", logger):
+            commands = get_merge_many_commands(
+                directories, destination,
+                operations[CommandCode.NEW_FROM_DN], operations[CommandCode.MAKE_DIR], operations[CommandCode.FILE_DIR_MATCH_CONFLICT],
+                max_workers
+            )
+        num_all_commands = len(commands)
+        commands = [x for x in commands if x.get_code() not in ignore_commands]
+        if len(commands) != num_all_commands:
+            Logger.log(f"Ignoring {num_all_commands - len(commands)} of {num_all_commands} commands", logger, "general")
 
     if not execute_commands:
         return commands
 
-    for i, command in enumerate(commands):
-        Logger.log(f"Executing ({i + 1}/{len(commands)}): {command}", logger, "general")
-        command.do(logger=logger)
-        Logger.log(f"Result: {command.get_result()}", logger, "general")
+    if merge_journal is not None:
+        if saved is None:
+            merge_journal.start(settings, commands)
+        else:
+            merge_journal.resume()
+    with Logger.time_span("directory_merge.merge_many_execute", logger):
+        run_commands(commands, logger, merge_journal, results)
+    if throttle is not None:
+        Logger.log(f"Throttled IO: {files.IOThrottle.format_stats(throttle.get_stats())}", logger, "general")
     Logger.log("Complete", logger, "general")
-    return commands
\ No newline at end of file
+    return commands
+
+
+# Compare consolidating the directories with merge_many against chaining two-way merges into the destination
+# Both runs write into temporary directories under work_dir (the system's temporary directory by default)
+def benchmark_merge_many(directories, work_dir=None, logger=None):
+    chained_dir = tempfile.mkdtemp(dir=work_dir)
+    many_dir = tempfile.mkdtemp(dir=work_dir)
+    try:
+        start = time.perf_counter()
+        for directory in directories:
+            merge(directory, chained_dir, chained_dir, ignore_commands=[CommandCode.NEW_FROM_D2, CommandCode.NEWEST_FROM_D2])
+        chained = time.perf_counter() - start
+
+        start = time.perf_counter()
+        merge_many(directories, many_dir)
+        many = time.perf_counter() - start
+        entries = sum(len(names) for _, _, names in os.walk(many_dir))
+    finally:
+        shutil.rmtree(chained_dir, ignore_errors=True)
+        shutil.rmtree(many_dir, ignore_errors=True)
+
+    result = MergeBenchmark(len(directories), entries, chained, many, chained / many if many > 0 else 0)
+    Logger.log(f"{len(directories)} directories ({entries} files): {chained:.3f}s chained, {many:.3f}s merge_many ({result.speedup:.2f}x)", logger)
+    return result
@@ -1,6 +1,11 @@
 # Utilities for counting files
 
 from . import files
+from . import logger as lg
+import os
+import re
+import time
+import bisect
 from collections import namedtuple
 
 
@@ -10,6 +15,15 @@ DELIMITER = "_"
 RelevantBackupNames = namedtuple("RelevantBackupNames", ["first", "last", "next"])
 
 
+# Any limit left as None is not enforced
+# max_bytes is the combined size of the backups and max_age is in seconds
+RetentionPolicy = namedtuple("RetentionPolicy", ["max_count", "max_bytes", "max_age"], defaults=[None, None, None])
+BackupMetadata = namedtuple("BackupMetadata", ["size", "mtime"])
+
+
+COUNT_PATTERN = re.compile(r"\d*")
+
+
 class Components:
     pre_count = ""
     count_str = ""
@@ -59,13 +73,7 @@ def decompose(string):
     if DELIMITER is not None:
         result.pre_count = string[:i + len(DELIMITER)]
 
-    count_str = ""
-    for char in string[i + len(DELIMITER):]:
-        try:
-            int(char)
-            count_str += char
-        except ValueError:
-            break
+    count_str = COUNT_PATTERN.match(string, i + len(DELIMITER)).group()
 
     result.count_str = count_str
     try:
@@ -142,4 +150,158 @@ def get_relevant_backup_names(src, backup_names, backup_dir):
         f"{backup_dir}/{get_first(backup_names)}",
         f"{backup_dir}/{get_last(backup_names)}",
         f"{backup_dir}/{get_next(backup_names)}"
-    )
\ No newline at end of file
+    )
+
+
+# Sorted view of a source's backups, built from a directory listing once and then kept up to date
+# Each name is parsed a single time; first, last and next are found without scanning the backups
+class BackupIndex:
+
+    def __init__(self, source_name, names=None):
+        self.source_name = source_name
+        leaf = files.path_to_leaf(source_name)
+        post_count = ""
+        if files.is_file_from_filename(source_name):
+            post_count = f".{files.get_extension(leaf)}"
+            leaf = files.remove_extension(leaf)
+        self.__pre_count = leaf + DELIMITER
+        self.__post_count = post_count
+        # Compressed backups (e.g. "name_3.txt.gz") belong to the same sequence as uncompressed ones
+        compression = "|".join(re.escape(f".{x}") for x in files.COMPRESSION_EXTENSIONS)
+        self.__pattern = re.compile(f"{re.escape(self.__pre_count)}(\\d+){re.escape(post_count)}(?:{compression})?")
+        # (count, name) pairs in ascending order
+        self.__backups = []
+        # name -> BackupMetadata (None when it wasn't provided)
+        self.__names = {}
+        if names is not None:
+            for name in names:
+                self.add(name)
+
+    # with_metadata: whether to record each backup's size and modification time (needed for retention)
+    @staticmethod
+    def from_directory(source_name, directory, with_metadata=False):
+        names = files.get_all_items(directory)
+        if names is None:
+            return None
+        index = BackupIndex(source_name)
+        for name in names:
+            if index.is_backup(name):
+                index.add(name, BackupIndex.read_metadata(f"{directory}/{name}") if with_metadata else None)
+        return index
+
+    @staticmethod
+    def read_metadata(filename):
+        try:
+            stat = os.stat(filename)
+        except OSError as e:
+            return None
+        size = stat.st_size if os.path.isfile(filename) else files.get_directory_size(filename)
+        return BackupMetadata(size, stat.st_mtime)
+
+    def parse_count(self, name):
+        match = self.__pattern.fullmatch(name)
+        return None if match is None else int(match.group(1))
+
+    def is_backup(self, name):
+        return self.parse_count(name) is not None
+
+    # Returns whether the name was added (False if it isn't a backup of the source or is already present)
+    def add(self, name, metadata=None):
+        count = self.parse_count(name)
+        if count is None or name in self.__names:
+            return False
+        bisect.insort(self.__backups, (count, name))
+        self.__names[name] = metadata
+        return True
+
+    def remove(self, name):
+        if name not in self.__names:
+            return False
+        count = self.parse_count(name)
+        self.__backups.pop(bisect.bisect_left(self.__backups, (count, name)))
+        del self.__names[name]
+        return True
+
+    def get_metadata(self, name):
+        return self.__names.get(name)
+
+    def set_metadata(self, name, metadata):
+        if name in self.__names:
+            self.__names[name] = metadata
+
+    def __len__(self):
+        return len(self.__backups)
+
+    def __contains__(self, name):
+        return name in self.__names
+
+    # Oldest (lowest count) to newest
+    def get_names(self):
+        return [x[1] for x in self.__backups]
+
+    def get_first(self):
+        return None if len(self.__backups) == 0 else self.__backups[0][1]
+
+    def get_last(self):
+        return None if len(self.__backups) == 0 else self.__backups[-1][1]
+
+    def get_next(self):
+        count = 0 if len(self.__backups) == 0 else self.__backups[-1][0] + 1
+        return f"{self.__pre_count}{count}{self.__post_count}"
+
+    def get_relevant_backup_names(self, backup_dir):
+        if len(self.__backups) == 0:
+            return RelevantBackupNames(None, None, f"{backup_dir}/{self.get_next()}")
+        return RelevantBackupNames(
+            f"{backup_dir}/{self.get_first()}",
+            f"{backup_dir}/{self.get_last()}",
+            f"{backup_dir}/{self.get_next()}"
+        )
+
+    # Remove (and return) the oldest names so that at most max_count remain
+    def prune(self, max_count):
+        num_removed = max(0, len(self.__backups) - max(0, max_count))
+        removed = [x[1] for x in self.__backups[:num_removed]]
+        del self.__backups[:num_removed]
+        for name in removed:
+            del self.__names[name]
+        return removed
+
+    # Names that don't satisfy the policy, found in a single pass from newest to oldest using the cached metadata
+    # Backups without metadata only count towards max_count
+    def get_expired(self, policy, now=None):
+        now = time.time() if now is None else now
+        expired = []
+        total_bytes = 0
+        for i, (count, name) in enumerate(reversed(self.__backups)):
+            metadata = self.__names[name]
+            size = 0 if metadata is None else metadata.size
+            total_bytes += size
+            if policy.max_count is not None and i >= policy.max_count:
+                expired.append(name)
+            elif policy.max_bytes is not None and total_bytes > policy.max_bytes:
+                expired.append(name)
+            elif policy.max_age is not None and metadata is not None and now - metadata.mtime > policy.max_age:
+                expired.append(name)
+        expired.reverse()
+        return expired
+
+
+# Delete the backups (in backup_dir) that don't satisfy the policy and remove them from the index
+# Returns the names that were deleted
+def apply_retention(index, policy, backup_dir, now=None, logger=None):
+    deleted = []
+    for name in index.get_expired(policy, now):
+        if files.delete(f"{backup_dir}/{name}", logger):
+            index.remove(name)
+            deleted.append(name)
+    return deleted
+
+
+# Standalone equivalent of apply_retention for scripts that don't keep an index around
+def enforce_retention(source_name, backup_dir, policy, now=None, logger=None):
+    index = BackupIndex.from_directory(source_name, backup_dir, with_metadata=True)
+    if index is None:
+        lg.Logger.log(f"Backup directory \"{backup_dir}\" does not exist", logger)
+        return []
+    return apply_retention(index, policy, backup_dir, now, logger)
@@ -1,8 +1,36 @@
 import os
+import time
+import hashlib
 import shutil
 import json
+import gzip
+import bz2
+import lzma
+import threading
+from collections import namedtuple
 from . import logger as lg
 
+try:
+    from compression import zstd  # Python 3.14+
+except ImportError:
+    zstd = None
+
+
+# Compression method -> (module providing open(), file extension)
+COMPRESSION_METHODS = {
+    "gzip": (gzip, "gz"),
+    "bz2": (bz2, "bz2"),
+    "lzma": (lzma, "xz")
+}
+if zstd is not None:
+    COMPRESSION_METHODS["zstd"] = (zstd, "zst")
+
+# Every extension a compressed file could have (including methods unavailable in this Python)
+COMPRESSION_EXTENSIONS = ["gz", "bz2", "xz", "zst"]
+
+# seconds is the time since the throttle was first used and waited is the total time callers spent blocked
+IOThrottleStats = namedtuple("IOThrottleStats", ["bytes", "ops", "seconds", "waited", "bytes_per_second", "ops_per_second"])
+
 
 def import_json(filename):
     lines = None
@@ -31,6 +59,15 @@ def get_file_size(filename):
     return os.path.getsize(filename)
 
 
+# Hex digest of a file's contents (read in blocks so large files aren't loaded at once)
+def get_file_hash(filename, algorithm="sha256", block_size=1024 * 1024):
+    digest = hashlib.new(algorithm)
+    with open(filename, "rb") as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 def is_file_from_filename(target):
     return target.rfind(".") >= 0
 
@@ -58,7 +95,113 @@ def get_directory_size(target):
     return size
 
 
-def copy(source, destination, max_use_of_free_space=1, logger=None):
+# Limits the rate of IO done through it to bytes_per_second and ops_per_second (None for no limit)
+# burst_seconds: how long a burst at the full rate can be after an idle period
+# Shared between threads (e.g. by every copy a merge makes) and adjustable while in use with set_rates
+class IOThrottle:
+
+    MAX_SLEEP = 0.1
+    DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, bytes_per_second=None, ops_per_second=None, burst_seconds=1):
+        self.__lock = threading.Lock()
+        self.__burst_seconds = burst_seconds
+        self.__byte_bucket = None
+        self.__op_bucket = None
+        self.__bytes = 0
+        self.__ops = 0
+        self.__waited = 0
+        self.__start = None
+        self.set_rates(bytes_per_second, ops_per_second)
+
+    def set_rates(self, bytes_per_second=None, ops_per_second=None):
+        with self.__lock:
+            self.bytes_per_second = bytes_per_second
+            self.ops_per_second = ops_per_second
+            self.__byte_bucket = IOThrottle.__update_bucket(self.__byte_bucket, bytes_per_second, self.__burst_seconds)
+            self.__op_bucket = IOThrottle.__update_bucket(self.__op_bucket, ops_per_second, self.__burst_seconds)
+
+    @staticmethod
+    def __update_bucket(bucket, rate, burst_seconds):
+        if rate is None:
+            return None
+        burst = max(1, rate * burst_seconds)
+        if bucket is None:
+            return lg.TokenBucket(rate, burst)
+        bucket.set_rate(rate, burst)
+        return bucket
+
+    # Largest read or write that can be requested at once (so the byte limit can always be met)
+    def get_chunk_size(self):
+        with self.__lock:
+            if self.__byte_bucket is None:
+                return IOThrottle.DEFAULT_CHUNK_SIZE
+            return max(1, int(min(IOThrottle.DEFAULT_CHUNK_SIZE, self.__byte_bucket.burst)))
+
+    # Block until num_bytes and ops can be used without going over the limits
+    def acquire(self, num_bytes=0, ops=1):
+        started = time.monotonic()
+        while True:
+            with self.__lock:
+                if self.__start is None:
+                    self.__start = started
+                byte_amount = 0 if self.__byte_bucket is None else min(num_bytes, self.__byte_bucket.burst)
+                op_amount = 0 if self.__op_bucket is None else min(ops, self.__op_bucket.burst)
+                wait = max(
+                    0 if self.__byte_bucket is None else self.__byte_bucket.get_wait(byte_amount),
+                    0 if self.__op_bucket is None else self.__op_bucket.get_wait(op_amount)
+                )
+                if wait <= 0:
+                    if self.__byte_bucket is not None:
+                        self.__byte_bucket.take(byte_amount)
+                    if self.__op_bucket is not None:
+                        self.__op_bucket.take(op_amount)
+                    self.__bytes += num_bytes
+                    self.__ops += ops
+                    self.__waited += time.monotonic() - started
+                    return
+            # Sleep in short steps so rate changes are noticed
+            time.sleep(min(wait, IOThrottle.MAX_SLEEP))
+
+    def get_stats(self):
+        with self.__lock:
+            seconds = 0 if self.__start is None else time.monotonic() - self.__start
+            return IOThrottleStats(
+                self.__bytes,
+                self.__ops,
+                seconds,
+                self.__waited,
+                self.__bytes / seconds if seconds > 0 else 0,
+                self.__ops / seconds if seconds > 0 else 0
+            )
+
+    @staticmethod
+    def format_stats(stats):
+        return (
+            f"{stats.bytes} bytes and {stats.ops} operations in {stats.seconds:.2f}s "
+            f"({stats.bytes_per_second / (1024 * 1024):.2f} MiB/s, {stats.ops_per_second:.1f} ops/s, {stats.waited:.2f}s waiting)"
+        )
+
+
+# Equivalent of shutil.copy2 that reads and writes in chunks through the throttle
+def copy_file_throttled(source, destination, throttle):
+    if os.path.isdir(destination):
+        destination = os.path.join(destination, os.path.basename(source))
+    chunk_size = throttle.get_chunk_size()
+    throttle.acquire(0, 1)
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        while True:
+            chunk = source_file.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            # Paying for each chunk before it is written also paces the reads
+            throttle.acquire(len(chunk), 1)
+            destination_file.write(chunk)
+    shutil.copystat(source, destination)
+    return destination
+
+
+def copy(source, destination, max_use_of_free_space=1, logger=None, throttle=None):
     if not target_exists(source):
         lg.Logger.log(f"Source \"{source}\" does not exist", logger)
         return False
@@ -74,18 +217,32 @@ def copy(source, destination, max_use_of_free_space=1, logger=None):
         if get_file_size(source) > space_allowance:
             lg.Logger.log(f"Source file \"{source}\" is too large to copy to \"{destination}\"", logger)
             return False
-        return copy_file(source, destination, logger)
+        with lg.Logger.time_span("files.copy", logger):
+            return copy_file(source, destination, logger, throttle)
     else:
         lg.Logger.log(f"Copying source directory \"{source}\" to \"{destination}\"", logger)
         if get_directory_size(source) > space_allowance:
             lg.Logger.log(f"Source directory \"{source}\" is too large to copy to \"{destination}\"", logger)
             return False
-        return copy_dir(source, destination, logger)
+        with lg.Logger.time_span("files.copy", logger):
+            return copy_dir(source, destination, logger, throttle)
+
+
+# Hard links share their contents, so a copy over one would change the file's other names too
+def __unlink_if_shared(source, destination):
+    if os.path.isdir(destination):
+        destination = os.path.join(destination, os.path.basename(source))
+    if os.path.isfile(destination) and os.stat(destination).st_nlink > 1:
+        os.unlink(destination)
 
 
-def copy_file(source, destination, logger=None):
+def copy_file(source, destination, logger=None, throttle=None):
     try:
-        shutil.copy2(source, destination)
+        __unlink_if_shared(source, destination)
+        if throttle is None:
+            shutil.copy2(source, destination)
+        else:
+            copy_file_throttled(source, destination, throttle)
         return True
     except IOError as e:
         lg.Logger.log(f"Error copying \"{source}\" to \"{destination}\"", logger)
@@ -98,9 +255,12 @@ def copy_file(source, destination, logger=None):
     return False
 
 
-def copy_dir(source, destination, logger=None):
+def copy_dir(source, destination, logger=None, throttle=None):
     try:
-        shutil.copytree(source, destination)
+        if throttle is None:
+            shutil.copytree(source, destination)
+        else:
+            shutil.copytree(source, destination, copy_function=lambda s, d: copy_file_throttled(s, d, throttle))
         return True
     except FileExistsError as e:
         lg.Logger.log(f"File in directory already exists while copying \"{source}\" to \"{destination}\"", logger)
@@ -195,4 +355,39 @@ def create_directory(directory):
     if not target_exists(directory):
         os.makedirs(directory)
         return True
-    return False
\ No newline at end of file
+    return False
+
+
+def get_compression_extension(method):
+    return COMPRESSION_METHODS[method][1]
+
+
+def strip_compression_extension(filename):
+    for extension in COMPRESSION_EXTENSIONS:
+        if filename.endswith(f".{extension}"):
+            return filename[:-len(extension) - 1]
+    return filename
+
+
+# Compress a file into "<filename>.<extension>" (replacing the original unless keep_source is set)
+# Returns the compressed file's name or None if it failed
+def compress_file(filename, method="gzip", keep_source=False, logger=None):
+    if method not in COMPRESSION_METHODS:
+        lg.Logger.log(f"Unsupported compression method: {method}", logger)
+        return None
+    module, extension = COMPRESSION_METHODS[method]
+    compressed_filename = f"{filename}.{extension}"
+    temp_filename = f"{compressed_filename}.tmp"
+    try:
+        with open(filename, "rb") as src, module.open(temp_filename, "wb") as dest:
+            shutil.copyfileobj(src, dest, 1024 * 1024)
+        os.replace(temp_filename, compressed_filename)
+    except Exception as e:
+        lg.Logger.log(f"Failed to compress \"{filename}\"", logger)
+        lg.Logger.log(f"Exception: {str(e)}", logger)
+        if target_exists(temp_filename):
+            delete_file(temp_filename, logger)
+        return None
+    if not keep_source:
+        delete_file(filename, logger)
+    return compressed_filename
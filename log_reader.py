@@ -0,0 +1,414 @@
+# Utilities for reading the files written by Printers.make_file_printer (the live log and its backups)
+# Files are memory-mapped and a sparse timestamp index is kept next to each one ("<log file>.idx") so
+# time-range queries can jump close to the first relevant line instead of reading from the top
+# Lines are assumed to be written in time order within each file
+
+import os
+import re
+import json
+import mmap
+import time
+import bisect
+import hashlib
+from collections import namedtuple
+from . import files
+from . import file_counting as fc
+from . import logger as lg
+
+
+# timestamp is seconds since the epoch (None if neither the line nor any line before it in the file has one)
+LogLine = namedtuple("LogLine", ["filename", "offset", "timestamp", "text"])
+
+
+INDEX_EXTENSION = "idx"
+INDEX_VERSION = 1
+# Number of leading bytes hashed to recognize a live file that was cleared and rewritten since it was indexed
+HEAD_SIZE = 1024
+# Only this much of the start of a line is searched for its timestamp and type
+PREAMBLE_SIZE = 256
+
+TEXT_TIMESTAMP_PATTERN = re.compile(rb"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}")
+JSON_TIMESTAMP_PATTERN = re.compile(rb'\{"timestamp": (-?[0-9.]+(?:[eE][-+]?[0-9]+)?)')
+TEXT_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+# Convert "YYYY-MM-DD HH:MM:SS" (local time, like the logger writes) to seconds since the epoch
+def parse_time(string):
+    return time.mktime(time.strptime(string, TEXT_TIMESTAMP_FORMAT))
+
+
+class TimestampParser:
+
+    def __init__(self):
+        # Many consecutive lines share a second, so the last conversion is reused
+        self.__last_text = None
+        self.__last_value = None
+
+    def parse(self, line):
+        match = JSON_TIMESTAMP_PATTERN.match(line)
+        if match is not None:
+            return float(match.group(1))
+        match = TEXT_TIMESTAMP_PATTERN.search(line, 0, PREAMBLE_SIZE)
+        if match is None:
+            return None
+        text = match.group()
+        if text != self.__last_text:
+            self.__last_text = text
+            self.__last_value = parse_time(text.decode("ascii"))
+        return self.__last_value
+
+
+# Matches lines of the given log types, written either as text (with do_type) or as JSON lines
+class TypeFilter:
+
+    def __init__(self, log_types):
+        self.__markers = []
+        for log_type in log_types:
+            self.__markers.append(f"({log_type}) ".encode("utf-8"))
+            self.__markers.append(f"\"type\": {json.encoder.encode_basestring(log_type)}".encode("utf-8"))
+
+    def matches(self, line):
+        end = min(len(line), PREAMBLE_SIZE + 64)
+        return any(line.find(x, 0, end) >= 0 for x in self.__markers)
+
+
+# Read-only view of a log file's contents
+# Uncompressed files are memory-mapped; compressed backups are decompressed into memory
+class LogFileView:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.__file = None
+        self.__map = None
+        compression = files.strip_compression_extension(filename) != filename
+        if compression:
+            extension = filename[filename.rfind(".") + 1:]
+            module = [x[0] for x in files.COMPRESSION_METHODS.values() if x[1] == extension]
+            if len(module) == 0:
+                raise ValueError(f"Unsupported compression for \"{filename}\"")
+            with module[0].open(filename, "rb") as f:
+                self.data = f.read()
+            return
+        self.__file = open(filename, "rb")
+        size = os.fstat(self.__file.fileno()).st_size
+        if size == 0:
+            self.data = b""
+            return
+        self.__map = mmap.mmap(self.__file.fileno(), size, access=mmap.ACCESS_READ)
+        self.data = self.__map
+
+    def __len__(self):
+        return len(self.data)
+
+    def close(self):
+        if self.__map is not None:
+            self.__map.close()
+        if self.__file is not None:
+            self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # (start, end) of every line from offset onwards (end excludes the newline)
+    def lines(self, offset=0, end=None):
+        data = self.data
+        end = len(data) if end is None else end
+        while offset < end:
+            newline = data.find(b"\n", offset, end)
+            if newline < 0:
+                yield offset, end
+                return
+            yield offset, newline
+            offset = newline + 1
+
+    # (start, end) of lines from the end of the file backwards (stopping at offset)
+    def lines_reversed(self, offset=0, end=None):
+        data = self.data
+        end = len(data) if end is None else end
+        if end > offset and data[end - 1:end] == b"\n":
+            end -= 1
+        while end > offset:
+            start = max(offset, data.rfind(b"\n", offset, end) + 1)
+            yield start, end
+            end = start - 1
+
+
+# Sparse index of (timestamp, offset) pairs for one log file
+class LogIndex:
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.timestamps = []
+        self.offsets = []
+        self.indexed_to = 0
+        self.next_mark = 0
+        self.last_timestamp = None
+        self.size = 0
+        self.mtime = 0
+        self.head = ""
+
+    @staticmethod
+    def get_index_filename(filename):
+        return f"{filename}.{INDEX_EXTENSION}"
+
+    @staticmethod
+    def get_head(view):
+        return hashlib.sha1(bytes(view.data[:HEAD_SIZE])).hexdigest()
+
+    # Index whatever has been added to the file since it was last indexed
+    def update(self, view, stat):
+        parser = TimestampParser()
+        data = view.data
+        if self.indexed_to > len(view):
+            return False
+        # A trailing partial line is left for next time
+        limit = data.rfind(b"\n") + 1
+        # Only the first timestamped line at or after each mark is parsed (jumping straight to the next mark after it)
+        position = max(self.indexed_to, self.next_mark)
+        while position < limit:
+            if position > 0 and data[position - 1:position] != b"\n":
+                position = data.find(b"\n", position, limit) + 1
+                if position == 0:
+                    break
+                continue
+            end = data.find(b"\n", position, limit)
+            line_timestamp = parser.parse(data[position:min(end, position + PREAMBLE_SIZE)])
+            if line_timestamp is None:
+                position = end + 1
+                continue
+            self.timestamps.append(line_timestamp)
+            self.offsets.append(position)
+            self.next_mark = position + self.interval
+            position = self.next_mark
+        # The latest timestamp comes from the last new line that has one
+        for start, end in view.lines_reversed(self.indexed_to, limit):
+            line_timestamp = parser.parse(data[start:min(end, start + PREAMBLE_SIZE)])
+            if line_timestamp is not None:
+                self.last_timestamp = line_timestamp
+                break
+        self.indexed_to = max(self.indexed_to, limit)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        if len(self.head) == 0 or self.size <= HEAD_SIZE:
+            self.head = LogIndex.get_head(view)
+        return True
+
+    # Offset to start scanning from so that no line at or after the given time is missed
+    def find_offset(self, timestamp):
+        if timestamp is None:
+            return 0
+        i = bisect.bisect_left(self.timestamps, timestamp)
+        return 0 if i == 0 else self.offsets[i - 1]
+
+    def to_dict(self):
+        return {
+            "version": INDEX_VERSION,
+            "interval": self.interval,
+            "size": self.size,
+            "mtime": self.mtime,
+            "head": self.head,
+            "indexed_to": self.indexed_to,
+            "next_mark": self.next_mark,
+            "last_timestamp": self.last_timestamp,
+            "entries": [list(x) for x in zip(self.timestamps, self.offsets)]
+        }
+
+    @staticmethod
+    def from_dict(data):
+        index = LogIndex(data["interval"])
+        index.size = data["size"]
+        index.mtime = data["mtime"]
+        index.head = data["head"]
+        index.indexed_to = data["indexed_to"]
+        index.next_mark = data["next_mark"]
+        index.last_timestamp = data["last_timestamp"]
+        index.timestamps = [x[0] for x in data["entries"]]
+        index.offsets = [x[1] for x in data["entries"]]
+        return index
+
+
+class LogReader:
+
+    # filename: the live log file (its backups are found in the same directory)
+    # index_interval: roughly how many bytes apart index entries are
+    # persist_index: whether to save indexes next to the log files
+    def __init__(self, filename, index_interval=64 * 1024, persist_index=True, encoding="utf-8", logger=None):
+        self.filename = filename
+        self.index_interval = index_interval
+        self.persist_index = persist_index
+        self.encoding = encoding
+        self.logger = logger
+        self.__indexes = {}
+
+    # Backups (oldest first) followed by the live file
+    def get_files(self):
+        log_dir = files.path_to_directory(self.filename)
+        backup_index = fc.BackupIndex.from_directory(self.filename, log_dir)
+        result = [] if backup_index is None else [f"{log_dir}/{x}" for x in backup_index.get_names()]
+        if files.target_exists(self.filename):
+            result.append(self.filename)
+        return result
+
+    # Delete saved indexes whose log file no longer exists (e.g. backups removed by retention)
+    def remove_unused_indexes(self):
+        log_dir = files.path_to_directory(self.filename)
+        backup_index = fc.BackupIndex(files.path_to_leaf(self.filename))
+        for name in files.get_all_items(log_dir) or []:
+            if not name.endswith(f".{INDEX_EXTENSION}"):
+                continue
+            log_name = name[:-len(INDEX_EXTENSION) - 1]
+            if log_name != files.path_to_leaf(self.filename) and not backup_index.is_backup(log_name):
+                continue
+            if not files.target_exists(f"{log_dir}/{log_name}"):
+                self.__indexes.pop(f"{log_dir}/{log_name}", None)
+                files.delete_file(f"{log_dir}/{name}", self.logger)
+
+    def __load_index(self, filename):
+        try:
+            with open(LogIndex.get_index_filename(filename), "r") as f:
+                data = json.load(f)
+            if data.get("version") != INDEX_VERSION or data.get("interval") != self.index_interval:
+                return None
+            return LogIndex.from_dict(data)
+        except (OSError, ValueError, KeyError) as e:
+            return None
+
+    def __save_index(self, filename, index):
+        index_filename = LogIndex.get_index_filename(filename)
+        try:
+            with open(f"{index_filename}.tmp", "w") as f:
+                json.dump(index.to_dict(), f)
+            os.replace(f"{index_filename}.tmp", index_filename)
+        except OSError as e:
+            lg.Logger.log(f"Failed to save index \"{index_filename}\"", self.logger)
+            lg.Logger.log(f"OSError: {str(e)}", self.logger)
+
+    # Bring the file's index up to date (reusing or extending a saved one when it still matches the file)
+    def get_index(self, filename, view):
+        stat = os.stat(filename)
+        index = self.__indexes.get(filename)
+        if index is None and self.persist_index:
+            index = self.__load_index(filename)
+        if index is not None:
+            unchanged = index.size == stat.st_size and index.mtime == stat.st_mtime
+            if unchanged:
+                self.__indexes[filename] = index
+                return index
+            # Appended to since it was indexed (a rotated and rewritten file won't share the same start)
+            grown = stat.st_size >= index.size and len(view) >= index.indexed_to and (index.size > HEAD_SIZE or index.size == 0)
+            if not grown or LogIndex.get_head(view) != index.head:
+                index = None
+        if index is None:
+            index = LogIndex(self.index_interval)
+        index.update(view, stat)
+        self.__indexes[filename] = index
+        if self.persist_index:
+            self.__save_index(filename, index)
+        return index
+
+    # None (after logging why) if the file can't be read, e.g. a backup deleted by retention since it was listed
+    # or one compressed with a method this Python doesn't support
+    def __open(self, filename):
+        try:
+            return LogFileView(filename)
+        except (OSError, ValueError, EOFError) as e:
+            lg.Logger.log(f"Skipping \"{filename}\" ({type(e).__name__}: {str(e)})", self.logger)
+            return None
+
+    def __decode(self, data):
+        return bytes(data).decode(self.encoding, errors="replace")
+
+    # Lines with timestamps in [start, end] (seconds since the epoch or "YYYY-MM-DD HH:MM:SS"; None is unbounded)
+    # log_types: only include lines of these types
+    def query(self, start=None, end=None, log_types=None):
+        start = parse_time(start) if isinstance(start, str) else start
+        end = parse_time(end) if isinstance(end, str) else end
+        type_filter = None if log_types is None else TypeFilter(log_types)
+        for filename in self.get_files():
+            view = self.__open(filename)
+            if view is None:
+                continue
+            with view:
+                try:
+                    index = self.get_index(filename, view)
+                except OSError as e:
+                    lg.Logger.log(f"Skipping \"{filename}\" (OSError: {str(e)})", self.logger)
+                    continue
+                if start is not None and index.last_timestamp is not None and index.last_timestamp < start:
+                    continue
+                yield from self.__scan(filename, view, index.find_offset(start), start, end, type_filter)
+
+    def __scan(self, filename, view, offset, start, end, type_filter):
+        parser = TimestampParser()
+        data = view.data
+        timestamp = None
+        for line_start, line_end in view.lines(offset):
+            preamble = data[line_start:min(line_end, line_start + PREAMBLE_SIZE)]
+            line_timestamp = parser.parse(preamble)
+            if line_timestamp is not None:
+                timestamp = line_timestamp
+            if end is not None and timestamp is not None and timestamp > end:
+                return
+            if start is not None and (timestamp is None or timestamp < start):
+                continue
+            line = data[line_start:line_end]
+            if type_filter is not None and not type_filter.matches(line):
+                continue
+            yield LogLine(filename, line_start, timestamp, self.__decode(line))
+
+    # The last n lines (of the given types) across the live file and its backups, oldest first
+    def tail(self, n=10, log_types=None):
+        type_filter = None if log_types is None else TypeFilter(log_types)
+        parser = TimestampParser()
+        result = []
+        for filename in reversed(self.get_files()):
+            view = self.__open(filename)
+            if view is None:
+                continue
+            with view:
+                for line_start, line_end in view.lines_reversed():
+                    line = view.data[line_start:line_end]
+                    if type_filter is not None and not type_filter.matches(line):
+                        continue
+                    result.append(LogLine(filename, line_start, parser.parse(line[:PREAMBLE_SIZE]), self.__decode(line)))
+                    if len(result) >= n:
+                        result.reverse()
+                        return result
+        result.reverse()
+        return result
+
+    # Yield lines as they are appended to the live file (starting from its current end unless from_start is set)
+    # A file that shrinks is assumed to have been rotated and is read again from the beginning
+    # stop: function returning True once following should end (checked between polls)
+    def follow(self, log_types=None, poll_interval=0.5, from_start=False, stop=None):
+        type_filter = None if log_types is None else TypeFilter(log_types)
+        parser = TimestampParser()
+        position = 0 if from_start or not files.target_exists(self.filename) else files.get_file_size(self.filename)
+        pending = b""
+        while stop is None or not stop():
+            try:
+                size = files.get_file_size(self.filename)
+            except OSError as e:
+                size = 0
+            if size < position:
+                position = 0
+                pending = b""
+            if size > position:
+                with open(self.filename, "rb") as f:
+                    f.seek(position)
+                    data = f.read(size - position)
+                line_offset = position - len(pending)
+                position += len(data)
+                lines = (pending + data).split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    offset = line_offset
+                    line_offset += len(line) + 1
+                    if type_filter is not None and not type_filter.matches(line):
+                        continue
+                    yield LogLine(self.filename, offset, parser.parse(line[:PREAMBLE_SIZE]), self.__decode(line))
+                continue
+            time.sleep(poll_interval)
@@ -1,10 +1,50 @@
+import os
+import json
+import math
 import time
+import queue
+import random
+import itertools
 import inspect
+import functools
 import threading
+import contextlib
+import multiprocessing
+from collections import namedtuple
+from multiprocessing.connection import Listener, Client
 from . import files
 from . import file_counting as fc
 
 
+# Produced instead of a formatted string when a Logger has do_structured set
+# timestamp is seconds since the epoch and location is None unless do_location is set
+class LogRecord(namedtuple("LogRecord", ["timestamp", "type", "identifier", "location", "thread", "message"])):
+
+    __slots__ = ()
+
+    # Hand-built equivalent of json.dumps(self._asdict()) (which is noticeably slower for such a small object)
+    def to_json(self):
+        encode = LogRecord.__encode
+        return (
+            f"{{\"timestamp\": {self.timestamp!r}, \"type\": {encode(self.type)}, \"identifier\": {encode(self.identifier)}, "
+            f"\"location\": {encode(self.location)}, \"thread\": {encode(self.thread)}, \"message\": {encode(self.message)}}}"
+        )
+
+    @staticmethod
+    def __encode(value):
+        if value is None:
+            return "null"
+        return json.encoder.encode_basestring(value if isinstance(value, str) else str(value))
+
+
+SuppressionCounts = namedtuple("SuppressionCounts", ["rate_limited", "duplicates", "sampled"], defaults=[0])
+LockStats = namedtuple("LockStats", ["acquisitions", "contended", "wait_time"])
+CollectorBenchmark = namedtuple("CollectorBenchmark", ["producers", "records", "seconds", "records_per_second"])
+LoggingBenchmark = namedtuple("LoggingBenchmark", ["records", "text_seconds", "structured_seconds", "json_dumps_seconds"])
+# Durations are in seconds (percentiles are estimates from a DurationHistogram)
+TimerStats = namedtuple("TimerStats", ["count", "total", "p50", "p95", "max"])
+
+
 class Logger:
 
     __universal_logger_name = "_"
@@ -32,6 +72,12 @@ class Logger:
     # do_unknown_type_exception: whether to raise an exception when missing log types are used
     # do_override_type_exception: whether to raise an exception when an attempt to override and existing attribute is made
     # do_prohibited_type_exception: whether to raise an exception when prohibited log types are used
+    # do_structured: whether to give the printer LogRecord objects instead of formatted strings
+    # rate_limits: dictionary of log type names to {"rate": messages per second, "burst": most messages at once}
+    # do_collapse_duplicates: whether to replace repeats of a type's last message with a "repeated N times" message
+    # sampling: dictionary of log type names to {"every": N} (keep 1 in N) or {"probability": p} (keep each with probability p)
+    # timer_log_type: log type that timer summaries are logged to (None to never log them)
+    # timer_summary_interval: seconds between timer summaries (checked whenever a span finishes; None to only log them on request)
     def __init__(
         self,
         types=None,
@@ -47,7 +93,13 @@ class Logger:
         do_unknown_type_exception=False,
         do_override_type_exception=True,
         do_prohibited_type_exception=True,
-        do_invalid_instance_call_exception=True
+        do_invalid_instance_call_exception=True,
+        do_structured=False,
+        rate_limits=None,
+        do_collapse_duplicates=False,
+        sampling=None,
+        timer_log_type=None,
+        timer_summary_interval=None
     ):
         self.__given_types = {} if types is None else types.copy()
         self.__types = {} if types is None else types.copy()
@@ -64,6 +116,20 @@ class Logger:
         self.__do_override_type_exception = do_override_type_exception
         self.__do_prohibited_type_exception = do_prohibited_type_exception
         self.__do_invalid_instance_call_exception = do_invalid_instance_call_exception
+        self.__do_structured = do_structured
+        self.__rate_limits = {} if rate_limits is None else {k: v.copy() for k, v in rate_limits.items()}
+        self.__do_collapse_duplicates = do_collapse_duplicates
+        self.__suppression_lock = threading.Lock()
+        self.__token_buckets = {name: TokenBucket(x["rate"], x.get("burst", x["rate"])) for name, x in self.__rate_limits.items()}
+        self.__last_messages = {}  # type -> [message, number of repeats]
+        self.__suppressed = {}  # type -> [rate limited, duplicates]
+        self.__sampling = {} if sampling is None else {k: v.copy() for k, v in sampling.items()}
+        self.__samplers = {name: Sampler(x.get("every"), x.get("probability")) for name, x in self.__sampling.items()}
+        self.__timer_log_type = timer_log_type
+        self.__timer_summary_interval = timer_summary_interval
+        self.__timer_lock = threading.Lock()
+        self.__timers = {}  # name -> DurationHistogram
+        self.__last_timer_summary = time.monotonic()
         self.__functions = {}
         self.input = self.__input_instance
         self.__prepare_logger()
@@ -101,15 +167,167 @@ class Logger:
 
 
     # Make the printer that will be added to the Logger instance
+    # A message can be given as a function returning the string so it is only built if the message is kept
     def __make_printer(self, name, use):
         def logger(string, *args, **kwargs):
             if use and self.__printer is not None:
-                preamble = self.__create_preamble_from_self(name)
-                # Use the provided printer to log the result
-                self.__printer(preamble + string, *args, **kwargs)
+                # Sampling is decided first so dropped calls do as little work as possible
+                sampler = self.__samplers.get(name)
+                if sampler is not None and not sampler.sample():
+                    return
+                if callable(string):
+                    string = string()
+                if (self.__do_collapse_duplicates or name in self.__token_buckets) and not self.__allow(name, string, *args, **kwargs):
+                    return
+                self.__emit(name, string, *args, **kwargs)
         return logger
 
 
+    def __emit(self, name, string, *args, **kwargs):
+        if self.__do_structured:
+            self.__printer(self.__create_record(name, string), *args, **kwargs)
+            return
+        preamble = self.__create_preamble_from_self(name)
+        # Use the provided printer to log the result
+        self.__printer(preamble + string, *args, **kwargs)
+
+
+    # Apply duplicate collapsing and rate limiting (in that order, so collapsed duplicates don't use up the rate)
+    def __allow(self, name, string, *args, **kwargs):
+        repeats = 0
+        with self.__suppression_lock:
+            if self.__do_collapse_duplicates:
+                last = self.__last_messages.get(name)
+                if last is not None and last[0] == string:
+                    last[1] += 1
+                    self.__count_suppressed(name, 1)
+                    return False
+                if last is not None:
+                    repeats = last[1]
+                self.__last_messages[name] = [string, 0]
+            bucket = self.__token_buckets.get(name)
+            allowed = bucket is None or bucket.take()
+            if not allowed:
+                self.__count_suppressed(name, 0)
+        if repeats > 0:
+            self.__emit(name, Logger.__repeated_message(repeats), *args, **kwargs)
+        return allowed
+
+
+    def __count_suppressed(self, name, kind):
+        if name not in self.__suppressed:
+            self.__suppressed[name] = [0, 0]
+        self.__suppressed[name][kind] += 1
+
+
+    @staticmethod
+    def __repeated_message(repeats):
+        return f"Last message repeated {repeats} time{'' if repeats == 1 else 's'}"
+
+
+    # Log the "repeated" messages that are waiting for a different message to come along
+    def flush_duplicates(self):
+        with self.__suppression_lock:
+            pending = [(name, x[1]) for name, x in self.__last_messages.items() if x[1] > 0]
+            self.__last_messages.clear()
+        for name, repeats in pending:
+            self.__emit(name, Logger.__repeated_message(repeats))
+
+
+    # Dictionary of log type names to SuppressionCounts
+    def get_suppressed_counts(self):
+        with self.__suppression_lock:
+            counts = {name: SuppressionCounts(x[0], x[1]) for name, x in self.__suppressed.items()}
+        for name, sampler in self.__samplers.items():
+            counts[name] = counts.get(name, SuppressionCounts(0, 0))._replace(sampled=sampler.dropped)
+        return counts
+
+
+    # every: keep one of every N messages; probability: keep each message with this probability
+    def set_sampling(self, name, every=None, probability=None):
+        if every is None and probability is None:
+            self.__sampling.pop(name, None)
+            self.__samplers.pop(name, None)
+            return
+        self.__sampling[name] = {"every": every} if every is not None else {"probability": probability}
+        self.__samplers[name] = Sampler(every, probability)
+
+
+    def set_rate_limit(self, name, rate, burst=None):
+        with self.__suppression_lock:
+            self.__rate_limits[name] = {"rate": rate, "burst": rate if burst is None else burst}
+            self.__token_buckets[name] = TokenBucket(rate, rate if burst is None else burst)
+
+
+    # Time a block ("with logger.span(name):") or, through timed(), a function
+    def span(self, name):
+        return Span(name, self.record_duration)
+
+
+    # Decorator timing each call of the function (under its qualified name unless one is given)
+    def timed(self, name=None):
+        def decorator(func):
+            span_name = func.__qualname__ if name is None else name
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with Span(span_name, self.record_duration):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+    def record_duration(self, name, seconds):
+        do_summary = False
+        with self.__timer_lock:
+            timer = self.__timers.get(name)
+            if timer is None:
+                timer = self.__timers[name] = DurationHistogram()
+            timer.add(seconds)
+            if self.__timer_summary_interval is not None and self.__timer_log_type is not None:
+                now = time.monotonic()
+                if now - self.__last_timer_summary >= self.__timer_summary_interval:
+                    self.__last_timer_summary = now
+                    do_summary = True
+        if do_summary:
+            self.log_timer_summary()
+
+
+    # Dictionary of span names to TimerStats
+    def get_timer_stats(self):
+        with self.__timer_lock:
+            return {name: x.get_stats() for name, x in self.__timers.items()}
+
+
+    def reset_timers(self):
+        with self.__timer_lock:
+            self.__timers.clear()
+
+
+    @staticmethod
+    def format_timer_stats(name, stats):
+        return (
+            f"Timer \"{name}\": count={stats.count}, total={stats.total:.3f}s, "
+            f"p50={stats.p50 * 1000:.3f}ms, p95={stats.p95 * 1000:.3f}ms, max={stats.max * 1000:.3f}ms"
+        )
+
+
+    # Log one line per timer to the given log type (timer_log_type by default)
+    def log_timer_summary(self, log_type=None):
+        log_type = self.__timer_log_type if log_type is None else log_type
+        if log_type is None:
+            log_type = Logger.__universal_logger_name
+        for name, stats in sorted(self.get_timer_stats().items()):
+            Logger.__log(Logger.format_timer_stats(name, stats), self, log_type)
+
+
+    # Time a block when the logger supports it (and do nothing otherwise, including when it is None)
+    @staticmethod
+    def time_span(name, logger=None):
+        if isinstance(logger, Logger.Proxy):
+            return logger.span(name)
+        return contextlib.nullcontext()
+
+
     def __add_type(self, name, active, check_prohibited=True, check_override=True):
         # Ignore attempts to use a prohibited name
         if check_prohibited and name in Logger.__prohibited_names:
@@ -226,6 +444,17 @@ class Logger:
         )
 
 
+    def __create_record(self, name, message):
+        return LogRecord(
+            time.time(),
+            name,
+            self.__identifier,
+            Logger.__get_caller_location(self.__do_short_location) if self.__do_location else None,
+            Logger.__get_thread_name(),
+            message
+        )
+
+
     # Get a named tuple containing the stack's info
     @staticmethod
     def __get_caller_frame_info(filename=None, function=None):
@@ -292,7 +521,7 @@ class Logger:
     def __log(message, logger=None, log_type=None, do_type_missing_indicator=True, *args, **kwargs):
         if logger is None or log_type is None:
             preamble = Logger.__create_preamble(name=log_type, identifier=None, do_type=True, do_timestamp=True, do_location=True, do_thread_name=True)
-            Logger.default_print(preamble + message, *args, **kwargs)
+            Logger.default_print(preamble + Logger.__resolve_message(message), *args, **kwargs)
             return
         logger_func = Logger.__get_function(logger, log_type)
         if logger_func is None:
@@ -300,6 +529,10 @@ class Logger:
                 raise LoggerExceptions.UnknownLoggerTypeException(f"Unknown logger type: {log_type}", log_type)
             if logger.__do_strict_types:
                 return
+            message = Logger.__resolve_message(message)
+            if logger.__do_structured:
+                logger.__printer(logger.__create_record(log_type, message), *args, **kwargs)
+                return
             preamble = logger.__create_preamble_from_self(log_type)
             type_missing_indicator = ("*" if (logger.__do_type_missing_indicator and do_type_missing_indicator) else "")
             logger.__printer(type_missing_indicator + preamble + message, *args, **kwargs)
@@ -307,13 +540,19 @@ class Logger:
         logger_func(message, *args, **kwargs)
 
 
+    # Messages given as functions are only called once it's known they'll be printed
+    @staticmethod
+    def __resolve_message(message):
+        return message() if callable(message) else message
+
+
     # Blocks off prohibited loggers
     @staticmethod
     def log(message, logger=None, log_type=None, *args, **kwargs):
         if logger is None:
             return
         if callable(logger) and not isinstance(logger, Logger.Proxy):
-            logger(message)
+            logger(Logger.__resolve_message(message))
             return
         if log_type in Logger.__prohibited_names:
             raise LoggerExceptions.ProhibitedLoggerTypeException(f"Prohibited logger name was given: {log_type}", log_type)
@@ -394,7 +633,13 @@ class Logger:
             do_strict_types=logger_settings["do_strict_types"],
             do_unknown_type_exception=logger_settings["type_error_handling"]["do_unknown_type_exception"],
             do_override_type_exception=logger_settings["type_error_handling"]["do_override_type_exception"],
-            do_prohibited_type_exception=logger_settings["type_error_handling"]["do_prohibited_type_exception"]
+            do_prohibited_type_exception=logger_settings["type_error_handling"]["do_prohibited_type_exception"],
+            do_structured=logger_settings.get("do_structured", False),
+            rate_limits=logger_settings.get("rate_limits"),
+            do_collapse_duplicates=logger_settings.get("do_collapse_duplicates", False),
+            sampling=logger_settings.get("sampling"),
+            timer_log_type=logger_settings.get("timer_log_type"),
+            timer_summary_interval=logger_settings.get("timer_summary_interval")
         )
 
 
@@ -413,7 +658,13 @@ class Logger:
             do_strict_types=settings["do_strict_types"],
             do_unknown_type_exception=settings["type_error_handling"]["do_unknown_type_exception"],
             do_override_type_exception=settings["type_error_handling"]["do_override_type_exception"],
-            do_prohibited_type_exception=settings["type_error_handling"]["do_prohibited_type_exception"]
+            do_prohibited_type_exception=settings["type_error_handling"]["do_prohibited_type_exception"],
+            do_structured=settings.get("do_structured", False),
+            rate_limits=settings.get("rate_limits"),
+            do_collapse_duplicates=settings.get("do_collapse_duplicates", False),
+            sampling=settings.get("sampling"),
+            timer_log_type=settings.get("timer_log_type"),
+            timer_summary_interval=settings.get("timer_summary_interval")
         )
 
 
@@ -428,6 +679,12 @@ class Logger:
                 "do_timestamp": self.__do_timestamp,
                 "do_type_missing_indicator": self.__do_type_missing_indicator,
                 "do_strict_types": self.__do_strict_types,
+                "do_structured": self.__do_structured,
+                "rate_limits": self.__rate_limits,
+                "do_collapse_duplicates": self.__do_collapse_duplicates,
+                "sampling": self.__sampling,
+                "timer_log_type": self.__timer_log_type,
+                "timer_summary_interval": self.__timer_summary_interval,
                 "type_error_handling": {
                     "do_unknown_type_exception": self.__do_unknown_type_exception,
                     "do_override_type_exception": self.__do_override_type_exception,
@@ -488,6 +745,119 @@ class Logger:
                     raise LoggerInvalidUsageExceptions.InvalidInstanceCallException(message)
 
 
+# Allows up to "burst" events at once, refilling at "rate" events per second
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.__tokens = burst
+        self.__last = time.monotonic()
+
+    # Not thread-safe on its own (callers hold their own lock)
+    def take(self, amount=1):
+        self.__refill()
+        if self.__tokens < amount:
+            return False
+        self.__tokens -= amount
+        return True
+
+    # Seconds until take(amount) would succeed
+    def get_wait(self, amount=1):
+        self.__refill()
+        return max(0, (amount - self.__tokens) / self.rate)
+
+    # rate and burst can also be changed while in use
+    def set_rate(self, rate, burst):
+        self.__refill()
+        self.rate = rate
+        self.burst = burst
+        self.__tokens = min(self.__tokens, burst)
+
+    def __refill(self):
+        now = time.monotonic()
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * self.rate)
+        self.__last = now
+
+
+# Decides which messages of a sampled log type are kept
+# Only one of every and probability is used (every takes precedence)
+class Sampler:
+
+    def __init__(self, every=None, probability=None):
+        if every is None and probability is None:
+            raise ValueError("Sampler requires either every or probability")
+        self.every = every
+        self.probability = probability
+        self.__counter = itertools.count()  # next() on a count is atomic, so no lock is needed
+        self.dropped = 0  # approximate when sampling from several threads at once
+
+    def sample(self):
+        if self.every is not None:
+            keep = next(self.__counter) % self.every == 0
+        else:
+            keep = random.random() < self.probability
+        if not keep:
+            self.dropped += 1
+        return keep
+
+
+# Counts of durations in logarithmically-sized buckets (each about 10% wider than the last)
+# Percentiles are accurate to within a bucket's width no matter how many durations are added
+class DurationHistogram:
+
+    MIN_DURATION = 1e-6
+    GROWTH = 1.1
+    __log_growth = math.log(GROWTH)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.__buckets = {}  # bucket -> count
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        bucket = 0 if seconds <= DurationHistogram.MIN_DURATION else int(math.log(seconds / DurationHistogram.MIN_DURATION) / DurationHistogram.__log_growth) + 1
+        self.__buckets[bucket] = self.__buckets.get(bucket, 0) + 1
+
+    # Upper bound of the bucket holding the given percentile (capped at the largest duration seen)
+    def get_percentile(self, percentile):
+        if self.count == 0:
+            return 0
+        target = math.ceil(self.count * percentile / 100)
+        seen = 0
+        for bucket in sorted(self.__buckets):
+            seen += self.__buckets[bucket]
+            if seen >= target:
+                return min(self.max, DurationHistogram.MIN_DURATION * DurationHistogram.GROWTH ** bucket)
+        return self.max
+
+    def get_stats(self):
+        return TimerStats(self.count, self.total, self.get_percentile(50), self.get_percentile(95), self.max)
+
+
+# Measures the time spent in a "with" block using a monotonic clock and passes it to record(name, seconds)
+class Span:
+
+    __slots__ = ("name", "record", "start")
+
+    def __init__(self, name, record):
+        self.name = name
+        self.record = record
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.record(self.name, time.perf_counter() - self.start)
+
+
 class LoggerExceptions:
 
     class LoggerNameException(Exception):
@@ -524,79 +894,296 @@ class LoggerInvalidUsageExceptions:
         pass
 
 
+# Lock that keeps track of how often (and for how long) callers had to wait for it
+class CountingLock:
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__acquisitions = 0
+        self.__contended = 0
+        self.__wait_time = 0
+
+    def acquire(self):
+        if not self.__lock.acquire(blocking=False):
+            start = time.perf_counter()
+            self.__lock.acquire()
+            # The counters are only changed while holding the lock
+            self.__contended += 1
+            self.__wait_time += time.perf_counter() - start
+        self.__acquisitions += 1
+        return True
+
+    def release(self):
+        self.__lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def get_stats(self):
+        return LockStats(self.__acquisitions, self.__contended, self.__wait_time)
+
+
 class Printers:
 
-    
-    file_printer_lock = threading.Lock()
+    # One lock per log file (by resolved path) shared by every file printer writing to it
+    __file_locks = {}
+    __file_locks_lock = threading.Lock()
+
+
+    @staticmethod
+    def get_file_lock(filename):
+        key = os.path.normcase(os.path.realpath(filename))
+        with Printers.__file_locks_lock:
+            if key not in Printers.__file_locks:
+                Printers.__file_locks[key] = CountingLock()
+            return Printers.__file_locks[key]
+
+
+    # LogRecords become JSON lines; anything else is passed through unchanged
+    @staticmethod
+    def to_line(item):
+        return item.to_json() if isinstance(item, LogRecord) else item
 
 
     @staticmethod
     def make_console_printer():
         def printer(string, *args, **kwargs):
-            print(string, *args, **kwargs)
+            print(Printers.to_line(string), *args, **kwargs)
         return printer
 
 
+    # Wrap a printer that only handles strings so it can be given LogRecords
+    @staticmethod
+    def make_json_lines_printer(printer):
+        def json_lines_printer(record, *args, **kwargs):
+            printer(Printers.to_line(record), *args, **kwargs)
+        return json_lines_printer
+
+
+    # max_size: size at which the file is rotated into a backup
+    # max_backups, max_total_size, max_age: retention limits for the backups (see file_counting.RetentionPolicy)
+    # compression: method used to compress backups (see files.COMPRESSION_METHODS), done on a background thread
     @staticmethod
-    def make_file_printer(filename, clear, max_size=None, max_backups=1):
+    def make_file_printer(filename, clear, max_size=None, max_backups=1, max_total_size=None, max_age=None, compression=None):
+        # Checked up front since compression failures happen on a background thread with nowhere to report them
+        if compression is not None and compression not in files.COMPRESSION_METHODS:
+            raise ValueError(f"Unsupported compression method: {compression} (supported: {', '.join(files.COMPRESSION_METHODS)})")
         log_dir = files.path_to_directory(filename)
+        retention_policy = fc.RetentionPolicy(max_backups, max_total_size, max_age)
+        compression_threads = []
+        lock = Printers.get_file_lock(filename)
 
         if not files.target_exists(filename):
             files.create_file(filename, "")
 
+        # Backups are listed once here and then tracked as they are created and deleted
+        backup_index = fc.BackupIndex.from_directory(filename, log_dir, with_metadata=True)
+
         if clear:
             files.clear_file(filename)
-            log_dir_items = files.get_all_items(log_dir)
-            for backup_filename in fc.get_backup_names(filename, log_dir_items):
+            for backup_filename in backup_index.prune(0):
                 backup_filename = f"{log_dir}/{backup_filename}"
                 if files.target_exists(backup_filename):
                     files.delete_file(backup_filename)
 
         def printer(string, do_newline=True):
-            with Printers.file_printer_lock:
+            nonlocal backup_index
+            string = Printers.to_line(string)
+            with lock:
                 if max_size is not None and files.get_file_size(filename) >= max_size:
-                    log_dir_items = files.get_all_items(log_dir)
-                    backup_log_filenames = fc.get_backup_names(filename, log_dir_items)
-                    next_log_filename = fc.get_relevant_backup_names(filename, backup_log_filenames, log_dir).next
+                    next_log_filename = backup_index.get_relevant_backup_names(log_dir).next
+                    if files.target_exists(next_log_filename):
+                        # Something else has been creating backups; start over from the directory's contents
+                        backup_index = fc.BackupIndex.from_directory(filename, log_dir, with_metadata=True)
+                        next_log_filename = backup_index.get_relevant_backup_names(log_dir).next
                     files.copy_file(filename, next_log_filename)
+                    backup_index.add(files.path_to_leaf(next_log_filename), fc.BackupIndex.read_metadata(next_log_filename))
                     files.clear_file(filename)
-
-                    while True:
-                        log_dir_items = files.get_all_items(log_dir)
-                        backup_log_filenames = fc.get_backup_names(filename, log_dir_items)
-                        if len(backup_log_filenames) <= max_backups or len(backup_log_filenames) == 0:
-                            break
-                        files.delete_file(fc.get_relevant_backup_names(filename, backup_log_filenames, log_dir).first)
+                    fc.apply_retention(backup_index, retention_policy, log_dir)
+                    if compression is not None:
+                        thread = threading.Thread(target=compress_backup, args=(next_log_filename,))
+                        compression_threads.append(thread)
+                        thread.start()
 
                 with open(filename, "a") as f:
                     try:
                         f.write(string + ("\n" if do_newline else ""))
                     except UnicodeEncodeError as e:
                         f.write("PRINTER ERROR: Cannot write string\n")
+
+        def compress_backup(backup_filename):
+            compressed_filename = files.compress_file(backup_filename, compression)
+            with lock:
+                compression_threads.remove(threading.current_thread())
+                if compressed_filename is None:
+                    return
+                if not backup_index.remove(files.path_to_leaf(backup_filename)):
+                    # Retention removed the backup while it was being compressed
+                    files.delete_file(compressed_filename)
+                    return
+                backup_index.add(files.path_to_leaf(compressed_filename), fc.BackupIndex.read_metadata(compressed_filename))
+
+        # Block until all backups have been compressed
+        def wait_for_compression():
+            while True:
+                with lock:
+                    if len(compression_threads) == 0:
+                        return
+                    thread = compression_threads[0]
+                thread.join()
+
+        printer.wait_for_compression = wait_for_compression
+        printer.get_lock_stats = lock.get_stats
         return printer
 
 
     @staticmethod
-    def make_combined_printer(filename, clear, max_file_size, max_backups):
+    def make_combined_printer(filename, clear, max_file_size, max_backups, max_total_size=None, max_age=None, compression=None):
         console_printer = Printers.make_console_printer()
-        file_printer = Printers.make_file_printer(filename, clear, max_file_size, max_backups)
+        file_printer = Printers.make_file_printer(filename, clear, max_file_size, max_backups, max_total_size, max_age, compression)
 
         def printer(string, do_file_newline=True, *args, **kwargs):
             console_printer(string, *args, **kwargs)
             file_printer(string, do_file_newline)
+        printer.wait_for_compression = file_printer.wait_for_compression
+        printer.get_lock_stats = file_printer.get_lock_stats
         return printer
 
 
+    # Keeps the last "capacity" items in memory and passes them to the target printer (oldest first) when a
+    # trigger item is logged or printer.flush() is called
+    # trigger_types: log types that cause a flush (detected from LogRecords or the "(type) " preamble of strings)
+    # trigger: function taking an item and returning whether to flush (replaces trigger_types)
     @staticmethod
-    def select_printer(do_logging, do_console_logging, do_file_logging, clear_log_file, output_filename, max_file_size, max_backups):
+    def make_ring_buffer_printer(target, capacity=1000, trigger_types=None, trigger=None):
+        if capacity < 1:
+            raise ValueError("Ring buffer capacity must be at least 1")
+        buffer = [None] * capacity
+        lock = threading.Lock()
+        state = {"next": 0, "count": 0}
+
+        if trigger is None:
+            trigger_types = set() if trigger_types is None else set(trigger_types)
+            markers = [f"({x}) " for x in trigger_types]
+
+            def trigger(item):
+                if isinstance(item, LogRecord):
+                    return item.type in trigger_types
+                # The type follows the type missing indicator and identifier (if there are any), not the message
+                line = item[1:] if item.startswith("*") else item
+                if not line.startswith("("):
+                    index = line.find(": ")
+                    line = "" if index < 0 else line[index + 2:]
+                return any(line.startswith(x) for x in markers)
+
+        def drain():
+            # Called with the lock held
+            start = (state["next"] - state["count"]) % capacity
+            items = [buffer[(start + i) % capacity] for i in range(state["count"])]
+            for i in range(capacity):
+                buffer[i] = None
+            state["next"] = 0
+            state["count"] = 0
+            return items
+
+        # Items are kept with the arguments they were printed with (e.g. a file printer's do_newline) so they can be replayed
+        def printer(item, *args, **kwargs):
+            with lock:
+                buffer[state["next"]] = (item, args, kwargs)
+                state["next"] = (state["next"] + 1) % capacity
+                state["count"] = min(state["count"] + 1, capacity)
+                if not trigger(item):
+                    return
+                items = drain()
+            for x, args, kwargs in items:
+                target(x, *args, **kwargs)
+
+        def flush():
+            with lock:
+                items = drain()
+            for x, args, kwargs in items:
+                target(x, *args, **kwargs)
+
+        def get_buffered():
+            with lock:
+                start = (state["next"] - state["count"]) % capacity
+                return [buffer[(start + i) % capacity][0] for i in range(state["count"])]
+
+        printer.flush = flush
+        printer.get_buffered = get_buffered
+        return printer
+
+
+    # Printer that sends lines to a LogCollector (possibly in another process)
+    # Lines are buffered and sent once batch_size have built up or flush_interval seconds have passed
+    # The connection is made per process, so the printer can be shared with forked workers
+    @staticmethod
+    def make_collector_printer(address, authkey, batch_size=100, flush_interval=0.1):
+        lock = threading.Lock()
+        state = {"pid": None, "connection": None, "batch": [], "closed": False}
+
+        def connect():
+            # Called with the lock held
+            if state["pid"] == os.getpid():
+                return
+            state["pid"] = os.getpid()
+            state["connection"] = Client(address, authkey=authkey)
+            state["batch"] = []
+            if flush_interval is not None:
+                threading.Thread(target=flush_periodically, daemon=True).start()
+
+        def send():
+            # Called with the lock held
+            if len(state["batch"]) > 0:
+                state["connection"].send(state["batch"])
+                state["batch"] = []
+
+        def flush_periodically():
+            pid = os.getpid()
+            while True:
+                time.sleep(flush_interval)
+                with lock:
+                    if state["closed"] or state["pid"] != pid:
+                        return
+                    send()
+
+        def printer(string, do_newline=True):
+            with lock:
+                connect()
+                state["batch"].append(Printers.to_line(string) + ("\n" if do_newline else ""))
+                if len(state["batch"]) >= batch_size:
+                    send()
+
+        def flush():
+            with lock:
+                if state["pid"] == os.getpid():
+                    send()
+
+        def close():
+            with lock:
+                if state["pid"] == os.getpid() and not state["closed"]:
+                    send()
+                    state["connection"].close()
+                state["closed"] = True
+
+        printer.flush = flush
+        printer.close = close
+        return printer
+
+
+    @staticmethod
+    def select_printer(do_logging, do_console_logging, do_file_logging, clear_log_file, output_filename, max_file_size, max_backups, max_total_size=None, max_age=None, compression=None):
         if not do_logging:
             return None
         elif do_console_logging and do_file_logging:
-            return Printers.make_combined_printer(output_filename, clear_log_file, max_file_size, max_backups)
+            return Printers.make_combined_printer(output_filename, clear_log_file, max_file_size, max_backups, max_total_size, max_age, compression)
         elif do_console_logging:
             return Printers.make_console_printer()
         elif do_file_logging:
-            return Printers.make_file_printer(output_filename, clear_log_file, max_file_size, max_backups)
+            return Printers.make_file_printer(output_filename, clear_log_file, max_file_size, max_backups, max_total_size, max_age, compression)
         return None
 
 
@@ -609,5 +1196,155 @@ class Printers:
             settings["file"]["clear"],
             settings["file"]["output_filename"],
             settings["file"]["max_file_size"],
-            settings["file"]["max_backups"]
-        )
\ No newline at end of file
+            settings["file"]["max_backups"],
+            settings["file"].get("max_total_size"),
+            settings["file"].get("max_age"),
+            settings["file"].get("compression")
+        )
+
+
+# Owns a log file (and its rotation) on behalf of any number of processes
+# Producers write through Printers.make_collector_printer(*collector.get_address()); each batch they
+# send is queued and a single writer merges whatever batches are waiting into one write
+class LogCollector:
+
+    def __init__(self, filename, clear, max_size=None, max_backups=1, max_total_size=None, max_age=None, compression=None, address=None):
+        self.__printer_args = (filename, clear, max_size, max_backups, max_total_size, max_age, compression)
+        self.__address = address
+        self.__authkey = os.urandom(16)
+        self.__process = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    # Address and authkey for Printers.make_collector_printer
+    def get_address(self):
+        return self.__address, self.__authkey
+
+    def start(self):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        self.__process = multiprocessing.Process(
+            target=LogCollector.serve,
+            args=(self.__printer_args, self.__address, self.__authkey, sender),
+            daemon=True
+        )
+        self.__process.start()
+        self.__address = receiver.recv()  # the collector reports the address it's listening on
+
+    # Waits for connected producers to disconnect and for everything to be written
+    def stop(self):
+        if self.__process is None:
+            return
+        connection = Client(self.__address, authkey=self.__authkey)
+        connection.send(None)
+        connection.close()
+        self.__process.join()
+        self.__process = None
+
+    # Runs in the collector process
+    @staticmethod
+    def serve(printer_args, address, authkey, address_sender):
+        printer = Printers.make_file_printer(*printer_args)
+        listener = Listener(address, authkey=authkey)
+        address_sender.send(listener.address)
+        address_sender.close()
+
+        batches = queue.Queue()
+        writer = threading.Thread(target=LogCollector.__write, args=(printer, batches))
+        writer.start()
+
+        # Each producer gets its own receiver as soon as it connects so a quiet one can't hold up the others
+        # The receiver that gets stop()'s None sets stopping and connects once more to wake the accept loop
+        stopping = threading.Event()
+        receivers = []
+        while True:
+            connection = listener.accept()
+            if stopping.is_set():
+                connection.close()
+                break
+            receiver = threading.Thread(target=LogCollector.__receive, args=(connection, batches, stopping, listener.address, authkey))
+            receivers.append(receiver)
+            receiver.start()
+        listener.close()
+
+        for receiver in receivers:
+            receiver.join()
+        batches.put(None)
+        writer.join()
+        printer.wait_for_compression()
+
+    @staticmethod
+    def __receive(connection, batches, stopping, address, authkey):
+        with connection:
+            while True:
+                try:
+                    batch = connection.recv()
+                except EOFError:
+                    return
+                if batch is None:
+                    stopping.set()
+                    Client(address, authkey=authkey).close()
+                    return
+                batches.put(batch)
+
+    @staticmethod
+    def __write(printer, batches, max_merged=1000):
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            lines = list(batch)
+            for _ in range(max_merged):
+                try:
+                    batch = batches.get_nowait()
+                except queue.Empty:
+                    break
+                if batch is None:
+                    printer("".join(lines), False)
+                    return
+                lines.extend(batch)
+            printer("".join(lines), False)
+
+
+def _benchmark_collector_producer(address, authkey, records, batch_size):
+    printer = Printers.make_collector_printer(address, authkey, batch_size)
+    for i in range(records):
+        printer(f"{os.getpid()}: record {i}")
+    printer.close()
+
+
+# Throughput of several producer processes writing to one file through a LogCollector
+def benchmark_log_collector(filename, producers=8, records=10000, batch_size=100):
+    with LogCollector(filename, True) as collector:
+        address, authkey = collector.get_address()
+        start = time.perf_counter()
+        processes = [multiprocessing.Process(target=_benchmark_collector_producer, args=(address, authkey, records, batch_size)) for _ in range(producers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        collector.stop()
+        seconds = time.perf_counter() - start
+    total = producers * records
+    return CollectorBenchmark(producers, total, seconds, total / seconds)
+
+
+# Compare the cost of producing text lines against structured JSON lines
+def benchmark_structured_logging(records=100000):
+    lines = []
+    text_logger = Logger({"info": True}, lines.append, "BENCH", do_timestamp=True, do_type=True, do_thread_name=True)
+    structured_logger = Logger({"info": True}, Printers.make_json_lines_printer(lines.append), "BENCH", do_structured=True)
+    dumps_logger = Logger({"info": True}, lambda record: lines.append(json.dumps(record._asdict())), "BENCH", do_structured=True)
+
+    def time_logger(logger):
+        lines.clear()
+        start = time.perf_counter()
+        for i in range(records):
+            logger.info("Comparing: some/path/to/a/file.txt")
+        return time.perf_counter() - start
+
+    return LoggingBenchmark(records, time_logger(text_logger), time_logger(structured_logger), time_logger(dumps_logger))
@@ -1,12 +1,47 @@
 from . import logger as lg
+from . import strings
+import os
+import sys
+import json
+import time
+import uuid
+import shlex
+import signal
+import codecs
+import queue
+import asyncio
+import threading
 import subprocess
 from collections import namedtuple
+from concurrent.futures import Future
 
 
-ProcessResults = namedtuple("ProcessResults", ["stdout", "stderr", "success"])
+ProcessResults = namedtuple("ProcessResults", ["stdout", "stderr", "success", "exit_code", "metrics"], defaults=[None, None])
+# Times are in seconds and max_rss is in bytes (CPU times and max_rss are None where os.wait4 is unavailable)
+ProcessMetrics = namedtuple("ProcessMetrics", ["wall_time", "user_time", "system_time", "max_rss", "exit_code", "stdout_bytes", "stderr_bytes"])
+ProcessMetricsSummary = namedtuple("ProcessMetricsSummary", ["name", "count", "failures", "total_wall_time", "max_wall_time", "total_cpu_time", "max_rss", "total_bytes"])
+StreamedOutput = namedtuple("StreamedOutput", ["source", "text"])
+PooledProcessResults = namedtuple("PooledProcessResults", ["stdout", "stderr", "success", "exit_code", "latency", "wait", "worker"])
+WorkerPoolStats = namedtuple("WorkerPoolStats", ["jobs", "failures", "restarts", "total_latency", "max_latency"])
+WorkerPoolBenchmark = namedtuple("WorkerPoolBenchmark", ["jobs", "cold_seconds", "warm_seconds", "saved_per_job"])
 
 
-def run_process(command, timeout=float("inf"), encoding="utf-8", logger=None):
+STDOUT = "stdout"
+STDERR = "stderr"
+ASYNC_READ_SIZE = 64 * 1024
+STREAM_READ_SIZE = 64 * 1024
+
+
+# collect_metrics: whether to measure the child's resource usage (included in the results' metrics field)
+# metrics_registry: a ProcessMetricsRegistry to record the metrics in (implies collect_metrics)
+# metrics_name: name to record the metrics under (defaults to the program's name)
+def run_process(command, timeout=float("inf"), encoding="utf-8", logger=None, collect_metrics=False, metrics_registry=None, metrics_name=None):
+    if collect_metrics or metrics_registry is not None:
+        result = __run_process_with_metrics(command, timeout, encoding, logger)
+        if metrics_registry is not None:
+            metrics_registry.record(get_command_name(command) if metrics_name is None else metrics_name, result.metrics, result.success)
+        return result
+
     process = subprocess.Popen(
         command,
         stdout=subprocess.PIPE,
@@ -15,7 +50,7 @@ def run_process(command, timeout=float("inf"), encoding="utf-8", logger=None):
 
     output = None
     try:
-        output = process.communicate(timeout=timeout)
+        output = process.communicate(timeout=(None if timeout == float("inf") else timeout))
     except subprocess.TimeoutExpired as e:
         lg.Logger.log(f"Failed to communicate with process (timeout: {timeout}): {command}", logger)
         process.kill()
@@ -23,4 +58,635 @@ def run_process(command, timeout=float("inf"), encoding="utf-8", logger=None):
     out = output[0].decode(encoding)
     err = output[1].decode(encoding)
 
-    return ProcessResults(out, err, True)
\ No newline at end of file
+    return ProcessResults(out, err, True, process.returncode)
+
+
+def get_command_name(command):
+    if isinstance(command, str):
+        command = command.split()
+    return "" if len(command) == 0 else os.path.basename(str(command[0]))
+
+
+# Reap the child with os.wait4 (instead of letting Popen do it) so its resource usage can be collected
+# Returns (None, None) if the child is still running at the deadline (a time.monotonic value)
+def __wait_with_usage(process, deadline=None):
+    if not hasattr(os, "wait4"):
+        try:
+            return process.wait(None if deadline is None else max(0, deadline - time.monotonic())), None
+        except subprocess.TimeoutExpired as e:
+            return None, None
+    if deadline is None:
+        _, status, usage = os.wait4(process.pid, 0)
+    else:
+        # Poll (backing off like Popen.wait does) since os.wait4 can't be given a timeout
+        delay = 0.0005
+        while True:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None, None
+            time.sleep(min(delay, remaining, 0.05))
+            delay *= 2
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage
+
+
+def __run_process_with_metrics(command, timeout, encoding, logger):
+    start = time.monotonic()
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+
+    # Read both pipes on threads (like communicate does) so neither can fill up and block the child
+    output = {}
+    def read(pipe, source):
+        output[source] = pipe.read()
+        pipe.close()
+    readers = [threading.Thread(target=read, args=(process.stdout, STDOUT), daemon=True),
+               threading.Thread(target=read, args=(process.stderr, STDERR), daemon=True)]
+    for reader in readers:
+        reader.start()
+    deadline = None if timeout == float("inf") else start + timeout
+    for reader in readers:
+        reader.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+    # The child can outlive its pipes (e.g. by closing or redirecting them), so waiting for it is also limited
+    timed_out = any(x.is_alive() for x in readers)
+    if not timed_out:
+        exit_code, usage = __wait_with_usage(process, deadline)
+        timed_out = exit_code is None
+    if timed_out:
+        lg.Logger.log(f"Failed to communicate with process (timeout: {timeout}): {command}", logger)
+        process.kill()
+        exit_code, usage = __wait_with_usage(process)
+    wall_time = time.monotonic() - start
+
+    out = b"" if timed_out else output[STDOUT]
+    err = b"" if timed_out else output[STDERR]
+    # ru_maxrss is reported in kilobytes everywhere except macOS
+    max_rss = None if usage is None else usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    metrics = ProcessMetrics(
+        wall_time,
+        None if usage is None else usage.ru_utime,
+        None if usage is None else usage.ru_stime,
+        max_rss,
+        exit_code,
+        len(out),
+        len(err)
+    )
+    if timed_out:
+        return ProcessResults("", "", False, None, metrics)
+    return ProcessResults(out.decode(encoding), err.decode(encoding), True, exit_code, metrics)
+
+
+# Aggregates ProcessMetrics by name so the most expensive commands can be found
+class ProcessMetricsRegistry:
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__summaries = {}
+
+    def record(self, name, metrics, success=True):
+        cpu_time = 0 if metrics.user_time is None else metrics.user_time + metrics.system_time
+        with self.__lock:
+            summary = self.__summaries.get(name, ProcessMetricsSummary(name, 0, 0, 0, 0, 0, None, 0))
+            max_rss = summary.max_rss
+            if metrics.max_rss is not None:
+                max_rss = metrics.max_rss if max_rss is None else max(max_rss, metrics.max_rss)
+            self.__summaries[name] = ProcessMetricsSummary(
+                name,
+                summary.count + 1,
+                summary.failures + (0 if success and metrics.exit_code == 0 else 1),
+                summary.total_wall_time + metrics.wall_time,
+                max(summary.max_wall_time, metrics.wall_time),
+                summary.total_cpu_time + cpu_time,
+                max_rss,
+                summary.total_bytes + metrics.stdout_bytes + metrics.stderr_bytes
+            )
+
+    # Summaries sorted from most to least total wall time
+    def get_summary(self):
+        with self.__lock:
+            return sorted(self.__summaries.values(), key=lambda x: x.total_wall_time, reverse=True)
+
+    def clear(self):
+        with self.__lock:
+            self.__summaries.clear()
+
+    def format_summary(self):
+        headers = ["name", "count", "failures", "wall (s)", "max wall (s)", "cpu (s)", "max rss (KiB)", "output (B)"]
+        rows = [[
+            x.name,
+            str(x.count),
+            str(x.failures),
+            f"{x.total_wall_time:.3f}",
+            f"{x.max_wall_time:.3f}",
+            f"{x.total_cpu_time:.3f}",
+            "-" if x.max_rss is None else str(x.max_rss // 1024),
+            str(x.total_bytes)
+        ] for x in self.get_summary()]
+        widths = [max(len(row[i]) for row in [headers] + rows) for i in range(len(headers))]
+        return "\n".join("  ".join(strings.pad_string(cell, widths[i]) for i, cell in enumerate(row)).rstrip() for row in [headers] + rows)
+
+
+# Incrementally yields a process' output instead of buffering all of it
+# Iterating produces StreamedOutput tuples (the source is STDOUT or STDERR) containing either
+# complete lines (split_lines=True, newlines removed) or decoded chunks as they arrive
+# At most max_buffered chunks are held at once; past that the process blocks on its own output
+# The timeout covers the entire iteration, after which the process is killed and success is False
+class ProcessStream:
+
+    def __init__(self, command, timeout=float("inf"), encoding="utf-8", logger=None, split_lines=True, line_callback=None, max_buffered=64, chunk_size=STREAM_READ_SIZE):
+        self.command = command
+        self.timeout = timeout
+        self.encoding = encoding
+        self.logger = logger
+        self.split_lines = split_lines
+        self.line_callback = line_callback
+        self.max_buffered = max_buffered
+        self.chunk_size = chunk_size
+        self.success = None
+        self.returncode = None
+        self.__started = False
+
+    def __iter__(self):
+        if self.__started:
+            raise RuntimeError("A ProcessStream can only be iterated once")
+        self.__started = True
+        return self.__stream()
+
+    # Consume the rest of the output (calling line_callback for each item) and return the results
+    def wait(self):
+        for _ in self:
+            pass
+        return self.success
+
+    def __reader(self, pipe, source, chunks, stop):
+        try:
+            while not stop.is_set():
+                data = pipe.read1(self.chunk_size)
+                if len(data) == 0:
+                    break
+                while not stop.is_set():
+                    try:
+                        chunks.put((source, data), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        finally:
+            pipe.close()
+            chunks.put((source, None))
+
+    def __emit(self, source, text):
+        output = StreamedOutput(source, text)
+        if self.line_callback is not None:
+            self.line_callback(output)
+        return output
+
+    def __stream(self):
+        process = subprocess.Popen(
+            self.command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        chunks = queue.Queue(maxsize=self.max_buffered)
+        stop = threading.Event()
+        for pipe, source in ((process.stdout, STDOUT), (process.stderr, STDERR)):
+            threading.Thread(target=self.__reader, args=(pipe, source, chunks, stop), daemon=True).start()
+
+        decoders = {source: codecs.getincrementaldecoder(self.encoding)() for source in (STDOUT, STDERR)}
+        pending = {STDOUT: "", STDERR: ""}
+        open_pipes = 2
+        deadline = None if self.timeout == float("inf") else time.monotonic() + self.timeout
+        try:
+            while open_pipes > 0:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                try:
+                    if remaining is not None and remaining <= 0:
+                        raise queue.Empty
+                    source, data = chunks.get(timeout=remaining)
+                except queue.Empty:
+                    lg.Logger.log(f"Failed to communicate with process (timeout: {self.timeout}): {self.command}", self.logger)
+                    process.kill()
+                    self.success = False
+                    return
+
+                final = data is None
+                text = decoders[source].decode(b"" if final else data, final=final)
+                if final:
+                    open_pipes -= 1
+                if not self.split_lines:
+                    if len(text) > 0:
+                        yield self.__emit(source, text)
+                    continue
+
+                lines = (pending[source] + text).split("\n")
+                pending[source] = "" if final else lines.pop()
+                if final and lines[-1] == "":
+                    lines.pop()
+                for line in lines:
+                    yield self.__emit(source, line)
+
+            self.success = True
+        finally:
+            stop.set()
+            if process.poll() is None:
+                process.kill()
+            self.returncode = process.wait()
+
+
+def stream_process(command, timeout=float("inf"), encoding="utf-8", logger=None, split_lines=True, line_callback=None, max_buffered=64):
+    return ProcessStream(command, timeout, encoding, logger, split_lines, line_callback, max_buffered)
+
+
+async def __create_process_async(command):
+    if isinstance(command, str):
+        # Windows command lines are passed through as-is (like Popen does), so let the shell parse them
+        if os.name == "nt":
+            return await asyncio.create_subprocess_shell(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        command = shlex.split(command)
+    return await asyncio.create_subprocess_exec(*command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+# Read a stream to the end, passing each completed line to the callback (if one was given)
+# Returns the text and the number of bytes read
+async def __read_stream_async(stream, encoding, callback):
+    decoder = codecs.getincrementaldecoder(encoding)()
+    chunks = []
+    pending = ""
+    num_bytes = 0
+    while True:
+        data = await stream.read(ASYNC_READ_SIZE)
+        num_bytes += len(data)
+        text = decoder.decode(data, final=(len(data) == 0))
+        chunks.append(text)
+        if callback is not None:
+            lines = (pending + text).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                callback(line)
+        if len(data) == 0:
+            break
+    if callback is not None and len(pending) > 0:
+        callback(pending)
+    return "".join(chunks), num_bytes
+
+
+async def __kill_process_async(process):
+    try:
+        process.kill()
+    except ProcessLookupError:
+        pass
+    await process.wait()
+
+
+# Asynchronous equivalent of run_process
+# stdout_callback and stderr_callback receive each line of output as soon as it is available
+# Metrics only include wall time, exit code and output sizes (the event loop reaps the child, so there's no resource usage)
+async def run_process_async(command, timeout=float("inf"), encoding="utf-8", logger=None, stdout_callback=None, stderr_callback=None,
+                            collect_metrics=False, metrics_registry=None, metrics_name=None):
+    start = time.monotonic()
+    try:
+        process = await __create_process_async(command)
+    except OSError as e:
+        lg.Logger.log(f"Failed to start process: {command}", logger)
+        lg.Logger.log(f"OSError: {str(e)}", logger)
+        return ProcessResults("", "", False)
+
+    timed_out = False
+    try:
+        (out, out_bytes), (err, err_bytes), _ = await asyncio.wait_for(
+            asyncio.gather(
+                __read_stream_async(process.stdout, encoding, stdout_callback),
+                __read_stream_async(process.stderr, encoding, stderr_callback),
+                process.wait()
+            ),
+            timeout=(None if timeout == float("inf") else timeout)
+        )
+    except asyncio.TimeoutError as e:
+        lg.Logger.log(f"Failed to communicate with process (timeout: {timeout}): {command}", logger)
+        await __kill_process_async(process)
+        timed_out = True
+    except asyncio.CancelledError as e:
+        await __kill_process_async(process)
+        raise e
+
+    metrics = None
+    if collect_metrics or metrics_registry is not None:
+        metrics = ProcessMetrics(
+            time.monotonic() - start,
+            None,
+            None,
+            None,
+            process.returncode,
+            0 if timed_out else out_bytes,
+            0 if timed_out else err_bytes
+        )
+        if metrics_registry is not None:
+            metrics_registry.record(get_command_name(command) if metrics_name is None else metrics_name, metrics, not timed_out)
+    if timed_out:
+        return ProcessResults("", "", False, None, metrics)
+    return ProcessResults(out, err, True, process.returncode, metrics)
+
+
+# Run many commands with at most max_concurrent processes alive at once
+# Results are returned in the same order as the commands
+# Callbacks receive the command along with each line of its output
+async def run_processes_async(commands, max_concurrent=32, timeout=float("inf"), encoding="utf-8", logger=None, stdout_callback=None, stderr_callback=None,
+                              collect_metrics=False, metrics_registry=None):
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    def bind(callback, command):
+        return None if callback is None else (lambda line: callback(command, line))
+
+    async def run(command):
+        async with semaphore:
+            return await run_process_async(
+                command, timeout, encoding, logger,
+                bind(stdout_callback, command),
+                bind(stderr_callback, command),
+                collect_metrics,
+                metrics_registry
+            )
+
+    return await asyncio.gather(*(run(command) for command in commands))
+
+
+# Blocking entry point to run_processes_async for code that doesn't use asyncio
+def run_processes(commands, max_concurrent=32, timeout=float("inf"), encoding="utf-8", logger=None, stdout_callback=None, stderr_callback=None,
+                  collect_metrics=False, metrics_registry=None):
+    return asyncio.run(run_processes_async(commands, max_concurrent, timeout, encoding, logger, stdout_callback, stderr_callback, collect_metrics, metrics_registry))
+
+
+
+# Source for the Python interpreter kept alive by a PythonWorker
+# Each request is a JSON line holding source code to execute; each response is a JSON line with its output
+PYTHON_WORKER_SOURCE = """
+import io, sys, json, contextlib, traceback
+channel = sys.stdout
+for request in sys.stdin:
+    out, err, exit_code = io.StringIO(), io.StringIO(), 0
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        try:
+            exec(json.loads(request)["code"], {"__name__": "__worker__"})
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except BaseException:
+            traceback.print_exc()
+            exit_code = 1
+    channel.write(json.dumps({"stdout": out.getvalue(), "stderr": err.getvalue(), "exit_code": exit_code}) + "\\n")
+    channel.flush()
+"""
+
+
+# Long-lived shell that runs one command at a time
+# Each command runs in a subshell and is followed by a unique marker (and its exit code) on stdout and stderr
+# so the end of its output can be found
+# Requires a POSIX shell
+class ShellWorker:
+
+    def __init__(self, shell=None, encoding="utf-8"):
+        self.encoding = encoding
+        self.process = subprocess.Popen(
+            ["sh"] if shell is None else shell,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True
+        )
+        self.__lines = {STDOUT: queue.Queue(), STDERR: queue.Queue()}
+        for pipe, source in ((self.process.stdout, STDOUT), (self.process.stderr, STDERR)):
+            threading.Thread(target=self.__reader, args=(pipe, self.__lines[source]), daemon=True).start()
+
+    @staticmethod
+    def __reader(pipe, lines):
+        for line in iter(pipe.readline, b""):
+            lines.put(line)
+        lines.put(None)
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    # The shell leads its own process group, so the commands it started are killed with it
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError as e:
+            pass
+        self.process.wait()
+
+    # Collect lines until the marker; returns None when the shell exits or the deadline passes first
+    def __read_until(self, source, marker, deadline):
+        lines = []
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                line = self.__lines[source].get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if line is None:
+                return None
+            if line.startswith(marker):
+                # Drop the newline that was written ahead of the marker
+                text = b"".join(lines)[:-1]
+                return text, line[len(marker):].strip()
+            lines.append(line)
+
+    # Returns (stdout, stderr, exit_code) or None if the worker died or timed out
+    def run(self, command, deadline=None):
+        marker = f"__worker_done_{uuid.uuid4().hex}__"
+        script = f"(\n{command}\n) </dev/null\nprintf '\\n{marker}%d\\n' $?\nprintf '\\n{marker}\\n' >&2\n"
+        try:
+            self.process.stdin.write(script.encode(self.encoding))
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            return None
+        out = self.__read_until(STDOUT, marker.encode(self.encoding), deadline)
+        err = None if out is None else self.__read_until(STDERR, marker.encode(self.encoding), deadline)
+        if err is None:
+            return None
+        try:
+            exit_code = int(out[1])
+        except ValueError:
+            exit_code = None
+        return out[0].decode(self.encoding), err[0].decode(self.encoding), exit_code
+
+
+# Long-lived Python interpreter that executes source code sent to it
+class PythonWorker:
+
+    def __init__(self, executable=None, encoding="utf-8"):
+        self.encoding = encoding
+        self.process = subprocess.Popen(
+            [sys.executable if executable is None else executable, "-u", "-c", PYTHON_WORKER_SOURCE],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+        self.__responses = queue.Queue()
+        threading.Thread(target=self.__reader, daemon=True).start()
+
+    def __reader(self):
+        for line in iter(self.process.stdout.readline, b""):
+            self.__responses.put(line)
+        self.__responses.put(None)
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        if self.is_alive():
+            self.process.kill()
+        self.process.wait()
+
+    def run(self, code, deadline=None):
+        try:
+            self.process.stdin.write((json.dumps({"code": code}) + "\n").encode(self.encoding))
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            return None
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        try:
+            response = self.__responses.get(timeout=remaining)
+        except queue.Empty:
+            return None
+        if response is None:
+            return None
+        response = json.loads(response.decode(self.encoding))
+        return response["stdout"], response["stderr"], response["exit_code"]
+
+
+# Keeps a number of workers warm and dispatches jobs to them
+# kind is "shell" (jobs are shell commands) or "python" (jobs are Python source)
+# Workers that crash or time out are replaced and their job is reported as unsuccessful
+class WorkerPool:
+
+    KINDS = {
+        "shell": ShellWorker,
+        "python": PythonWorker
+    }
+
+    def __init__(self, size=4, kind="shell", executable=None, encoding="utf-8", timeout=float("inf"), logger=None):
+        if kind not in WorkerPool.KINDS:
+            raise ValueError(f"Unknown worker kind: {kind}")
+        self.size = size
+        self.kind = kind
+        self.executable = executable
+        self.encoding = encoding
+        self.timeout = timeout
+        self.logger = logger
+        self.__jobs = queue.Queue()
+        self.__stats_lock = threading.Lock()
+        self.__jobs_done = 0
+        self.__failures = 0
+        self.__restarts = 0
+        self.__total_latency = 0
+        self.__max_latency = 0
+        self.__closed = False
+        self.__threads = [threading.Thread(target=self.__dispatch, args=(i,), daemon=True) for i in range(size)]
+        for thread in self.__threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __make_worker(self):
+        arg = self.executable
+        if self.kind == "shell" and isinstance(arg, str):
+            arg = [arg]
+        return WorkerPool.KINDS[self.kind](arg, self.encoding)
+
+    def __dispatch(self, index):
+        worker = self.__make_worker()
+        while True:
+            job = self.__jobs.get()
+            if job is None:
+                break
+            command, timeout, submitted, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            if not worker.is_alive():
+                worker = self.__restart(worker, index, "exited")
+
+            start = time.monotonic()
+            timeout = self.timeout if timeout is None else timeout
+            deadline = None if timeout == float("inf") else start + timeout
+            output = worker.run(command, deadline)
+            latency = time.monotonic() - start
+
+            if output is None:
+                lg.Logger.log(f"Worker {index} failed to complete job (timeout: {timeout}): {command}", self.logger)
+                worker = self.__restart(worker, index, "failed")
+                result = PooledProcessResults("", "", False, None, latency, start - submitted, index)
+            else:
+                result = PooledProcessResults(output[0], output[1], True, output[2], latency, start - submitted, index)
+            self.__record(result)
+            future.set_result(result)
+        worker.kill()
+
+    def __restart(self, worker, index, reason):
+        lg.Logger.log(f"Restarting worker {index} ({reason})", self.logger)
+        worker.kill()
+        with self.__stats_lock:
+            self.__restarts += 1
+        return self.__make_worker()
+
+    def __record(self, result):
+        with self.__stats_lock:
+            self.__jobs_done += 1
+            self.__failures += 0 if result.success else 1
+            self.__total_latency += result.latency
+            self.__max_latency = max(self.__max_latency, result.latency)
+
+    def submit(self, command, timeout=None):
+        if self.__closed:
+            raise RuntimeError("Cannot submit jobs to a closed WorkerPool")
+        future = Future()
+        self.__jobs.put((command, timeout, time.monotonic(), future))
+        return future
+
+    def run(self, command, timeout=None):
+        return self.submit(command, timeout).result()
+
+    def map(self, commands, timeout=None):
+        return [x.result() for x in [self.submit(command, timeout) for command in commands]]
+
+    def get_stats(self):
+        with self.__stats_lock:
+            return WorkerPoolStats(self.__jobs_done, self.__failures, self.__restarts, self.__total_latency, self.__max_latency)
+
+    # Waits for queued jobs to finish before stopping the workers
+    def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        for _ in self.__threads:
+            self.__jobs.put(None)
+        for thread in self.__threads:
+            thread.join()
+
+
+# Compare starting a fresh interpreter for each job against reusing a warm PythonWorker
+def benchmark_worker_pool(code="print(sum(range(1000)))", jobs=50, logger=None):
+    start = time.perf_counter()
+    for _ in range(jobs):
+        run_process([sys.executable, "-c", code], logger=logger)
+    cold = time.perf_counter() - start
+
+    with WorkerPool(size=1, kind="python", logger=logger) as pool:
+        pool.run("pass")  # exclude the worker's own startup
+        start = time.perf_counter()
+        for _ in range(jobs):
+            pool.run(code)
+        warm = time.perf_counter() - start
+
+    result = WorkerPoolBenchmark(jobs, cold, warm, (cold - warm) / jobs)
+    lg.Logger.log(f"{jobs} jobs: {cold:.3f}s cold, {warm:.3f}s warm ({result.saved_per_job * 1000:.2f}ms saved per job)", logger)
+    return result
@@ -1,44 +1,421 @@
 # https://pypi.org/project/pytesseract/
 # py -m pip install pytesseract
 
-from PIL import Image
+from PIL import Image, ImageSequence
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import pytesseract
+import os
 import sys
+import time
+import math
+import hashlib
+import threading
+
+try:
+    from . import files
+except ImportError:
+    # Run as a script, so import the package this file is in (its other modules use relative imports)
+    import importlib
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    files = importlib.import_module(f"{os.path.basename(os.path.dirname(os.path.abspath(__file__)))}.files")
+
+
+# text is None when the image could not be processed (error then describes why)
+OcrResult = namedtuple("OcrResult", ["filename", "text", "error"])
+# page is the frame's index and tile is the index of the tile within that frame
+PageResult = namedtuple("PageResult", ["page", "tile", "text", "error", "seconds"])
+# text joins every page (separated by form feeds), with failed parts left empty (their PageResult has the error)
+DocumentResult = namedtuple("DocumentResult", ["filename", "text", "pages"])
+PreprocessingBenchmark = namedtuple("PreprocessingBenchmark", ["filename", "pixels", "seconds", "preprocessed_pixels", "preprocessed_seconds"])
+OcrCacheStats = namedtuple("OcrCacheStats", ["hits", "misses", "evictions", "entries", "size"])
+
+
+IMAGE_EXTENSIONS = ["bmp", "gif", "jpeg", "jpg", "png", "tif", "tiff", "webp"]
+
 
 class Tesseract:
 
-    def __init__(self, path=None):
+    PAGE_SEPARATOR = "\f"
+
+    # lang and config are passed to pytesseract
+    # cache: an OcrCache used to skip images that were already processed with the same settings
+    # preprocessing: a Preprocessing applied to each image before it is given to Tesseract
+    # max_tile_height: pages taller than this (in pixels) are split into tiles by image_to_document
+    def __init__(self, path=None, lang=None, config="", cache=None, preprocessing=None, max_tile_height=None):
         path = Tesseract.make_path_safe(path)
         self.tess_path = path
+        self.lang = lang
+        self.config = config
+        self.cache = cache
+        self.preprocessing = preprocessing
+        self.max_tile_height = max_tile_height
         if path is not None:
             pytesseract.pytesseract.tesseract_cmd = path
 
+    # The cache is left behind when the instance is sent to worker processes
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["cache"] = None
+        return state
+
+    # Everything other than the image that affects the output
+    def get_settings_key(self):
+        preprocessing = None if self.preprocessing is None else self.preprocessing.get_key()
+        return f"lang={self.lang}|config={self.config}|preprocessing={preprocessing}"
+
     def image_to_string(self, filename):
+        result = self.image_to_result(filename)
+        if result.error is not None:
+            print(result.error, file=sys.stderr)
+        return result.text
+
+    def image_to_result(self, filename):
         filename = Tesseract.make_path_safe(filename)
+        cache_key = None
+        if self.cache is not None:
+            try:
+                cache_key = self.cache.make_key(filename, self.get_settings_key())
+            except FileNotFoundError as e:
+                return OcrResult(filename, None, "Could not find file for Image object")
+            text = self.cache.get(cache_key)
+            if text is not None:
+                return OcrResult(filename, text, None)
+
         try:
             image = Image.open(filename)
         except FileNotFoundError as e:
-            print("Could not find file for Image object", file=sys.stderr)
-            return None
+            return OcrResult(filename, None, "Could not find file for Image object")
+
+        text, error = self.__ocr_image(image)
+        if error is not None:
+            return OcrResult(filename, None, error)
+
+        if cache_key is not None:
+            self.cache.put(cache_key, text)
+        return OcrResult(filename, text, None)
+
+    # Returns the text and an error message (one of which is None)
+    def __ocr_image(self, image, do_preprocessing=True):
+        if do_preprocessing and self.preprocessing is not None:
+            image = self.preprocessing.apply(image)
 
         try:
-            return pytesseract.image_to_string(image)
+            return pytesseract.image_to_string(image, lang=self.lang, config=self.config), None
         except FileNotFoundError as e:
-            print("Could not find file for text extraction", file=sys.stderr)
-            return None
+            return None, "Could not find file for text extraction"
         except pytesseract.pytesseract.TesseractNotFoundError as e:
-            print("Ensure Tesseract is on your path", file=sys.stderr)
-            return None
-        
-        return None
+            return None, "Ensure Tesseract is on your path"
+
+    def __ocr_part(self, page, tile, image):
+        start = time.perf_counter()
+        try:
+            # Frames are preprocessed before being split (crop boxes are in the whole frame's coordinates)
+            text, error = self.__ocr_image(image, False)
+        except Exception as e:
+            text, error = None, f"{type(e).__name__}: {str(e)}"
+        return PageResult(page, tile, text, error, time.perf_counter() - start)
+
+    # OCR every frame of an image (e.g. a multi-page TIFF), splitting tall frames into tiles
+    # The parts are processed concurrently (each pytesseract call is its own process) and reassembled in order
+    def image_to_document(self, filename, workers=None):
+        filename = Tesseract.make_path_safe(filename)
+        cache_key = None
+        if self.cache is not None:
+            try:
+                cache_key = self.cache.make_key(filename, f"{self.get_settings_key()}|document|max_tile_height={self.max_tile_height}")
+            except FileNotFoundError as e:
+                return DocumentResult(filename, None, [PageResult(0, 0, None, "Could not find file for Image object", 0)])
+            text = self.cache.get(cache_key)
+            if text is not None:
+                return DocumentResult(filename, text, [])
+
+        try:
+            image = Image.open(filename)
+        except FileNotFoundError as e:
+            return DocumentResult(filename, None, [PageResult(0, 0, None, "Could not find file for Image object", 0)])
+
+        parts = []
+        failed = []
+        with image:
+            for page, frame in enumerate(ImageSequence.Iterator(image)):
+                frame = frame.copy()
+                if self.preprocessing is not None:
+                    start = time.perf_counter()
+                    try:
+                        frame = self.preprocessing.apply(frame)
+                    except Exception as e:
+                        failed.append(PageResult(page, 0, None, f"{type(e).__name__}: {str(e)}", time.perf_counter() - start))
+                        continue
+                for tile, part in enumerate(Tesseract.split_tall_image(frame, self.max_tile_height)):
+                    parts.append((page, tile, part))
+
+        workers = os.cpu_count() if workers is None else workers
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda x: self.__ocr_part(*x), parts))
+        results = sorted(results + failed, key=lambda x: (x.page, x.tile))
+
+        # A failed part leaves a gap rather than losing the whole document's text
+        pages = {}
+        for result in results:
+            pages.setdefault(result.page, []).append("" if result.text is None else result.text)
+        text = Tesseract.PAGE_SEPARATOR.join("".join(pages[x]) for x in sorted(pages))
+        # Only complete documents are cached so failed parts are retried next time
+        if cache_key is not None and all(x.error is None for x in results):
+            self.cache.put(cache_key, text)
+        return DocumentResult(filename, text, results)
+
+    # Split an image into pieces no taller than max_height
+    # Each cut is made at the lightest row in the last tenth of the piece so lines of text are less likely to be cut
+    @staticmethod
+    def split_tall_image(image, max_height):
+        if max_height is None or image.height <= max_height:
+            return [image]
+        # Shrinking to a single column gives the mean of each row
+        row_means = list(image.convert("L").resize((1, image.height), Image.BOX).getdata())
+        window = max(1, max_height // 10)
+        tiles = []
+        top = 0
+        while image.height - top > max_height:
+            limit = top + max_height
+            cut = max(range(limit - window, limit + 1), key=lambda y: (row_means[y], y))
+            tiles.append(image.crop((0, top, image.width, cut)))
+            top = cut
+        tiles.append(image.crop((0, top, image.width, image.height)))
+        return tiles
+
+    # Yields an OcrResult for each image as soon as it completes (not necessarily in the given order)
+    # workers defaults to the number of cores
+    def images_to_results(self, filenames, workers=None):
+        workers = os.cpu_count() if workers is None else workers
+        # Cached images are answered here; only the rest are sent to the pool
+        pending = {}
+        for filename in filenames:
+            filename = Tesseract.make_path_safe(filename)
+            if self.cache is None:
+                pending[filename] = None
+                continue
+            try:
+                cache_key = self.cache.make_key(filename, self.get_settings_key())
+            except FileNotFoundError as e:
+                yield OcrResult(filename, None, "Could not find file for Image object")
+                continue
+            text = self.cache.get(cache_key)
+            if text is not None:
+                yield OcrResult(filename, text, None)
+            else:
+                pending[filename] = cache_key
+
+        if len(pending) == 0:
+            return
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self.tess_path,)) as executor:
+            futures = [executor.submit(_ocr_worker, self, filename) for filename in pending]
+            for future in as_completed(futures):
+                result = future.result()
+                cache_key = pending.get(result.filename)
+                if cache_key is not None and result.error is None:
+                    self.cache.put(cache_key, result.text)
+                yield result
+
+    def directory_to_results(self, directory, workers=None):
+        return self.images_to_results(Tesseract.list_images(directory), workers)
+
+    # Write each result to "<output directory>/<image name>.txt" as it completes
+    # Returns the failed results
+    @staticmethod
+    def write_results(results, output_directory):
+        os.makedirs(output_directory, exist_ok=True)
+        failures = []
+        for result in results:
+            if result.error is not None:
+                print(f"{result.filename}: {result.error}", file=sys.stderr)
+                failures.append(result)
+                continue
+            output_filename = os.path.join(output_directory, f"{os.path.basename(result.filename)}.txt")
+            with open(output_filename, "w") as f:
+                f.write(result.text)
+        return failures
+
+    @staticmethod
+    def list_images(directory):
+        directory = Tesseract.make_path_safe(directory)
+        return [
+            f"{directory}/{x}" for x in sorted(os.listdir(directory))
+            if x[x.rfind(".") + 1:].lower() in IMAGE_EXTENSIONS and os.path.isfile(f"{directory}/{x}")
+        ]
 
     @staticmethod
     def make_path_safe(path):
         return path if path is None else path.replace("\\", "/")
 
 
+# Image adjustments made before OCR
+# grayscale: convert to a single channel
+# threshold: binarize (pixels at or above the threshold become white, the rest black); implies grayscale
+# target_dpi: downscale images whose DPI (from their metadata) is higher than this
+# max_pixels: downscale images with more pixels than this (applied after target_dpi)
+# crop: (left, upper, right, lower) region to keep, in the original image's pixels
+class Preprocessing:
+
+    def __init__(self, grayscale=False, threshold=None, target_dpi=None, max_pixels=None, crop=None):
+        self.grayscale = grayscale
+        self.threshold = threshold
+        self.target_dpi = target_dpi
+        self.max_pixels = max_pixels
+        self.crop = None if crop is None else tuple(crop)
+
+    def get_key(self):
+        return f"grayscale={self.grayscale},threshold={self.threshold},target_dpi={self.target_dpi},max_pixels={self.max_pixels},crop={self.crop}"
+
+    # Cropping and converting can drop the image's metadata, so the original DPI is passed in
+    def get_scale(self, image, dpi=None):
+        scale = 1
+        if self.target_dpi is not None and dpi is not None and dpi[0] > self.target_dpi:
+            scale = self.target_dpi / dpi[0]
+        pixels = image.width * image.height * scale * scale
+        if self.max_pixels is not None and pixels > self.max_pixels:
+            scale *= math.sqrt(self.max_pixels / pixels)
+        return scale
+
+    def apply(self, image):
+        dpi = image.info.get("dpi")
+        if self.crop is not None:
+            image = image.crop(self.crop)
+        # Converting first means there's less data to resize
+        if self.grayscale or self.threshold is not None:
+            image = image.convert("L")
+        scale = self.get_scale(image, dpi)
+        if scale < 1:
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            image = image.resize(size, Image.LANCZOS)
+            if dpi is not None:
+                image.info["dpi"] = (dpi[0] * scale, dpi[1] * scale)
+        if self.threshold is not None:
+            threshold = self.threshold
+            image = image.point(lambda x: 255 if x >= threshold else 0)
+        return image
+
+
+# Time OCR of each image with and without the given preprocessing
+def benchmark_preprocessing(filenames, preprocessing, tess_path=None, lang=None, config=""):
+    raw = Tesseract(tess_path, lang, config)
+    processed = Tesseract(tess_path, lang, config, preprocessing=preprocessing)
+    results = []
+    for filename in filenames:
+        with Image.open(filename) as image:
+            pixels = image.width * image.height
+            preprocessed_pixels = preprocessing.apply(image).size
+        start = time.perf_counter()
+        raw.image_to_result(filename)
+        seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        processed.image_to_result(filename)
+        preprocessed_seconds = time.perf_counter() - start
+        results.append(PreprocessingBenchmark(filename, pixels, seconds, preprocessed_pixels[0] * preprocessed_pixels[1], preprocessed_seconds))
+    return results
+
+
+def format_preprocessing_benchmark(results):
+    lines = ["pixels -> preprocessed pixels: seconds -> preprocessed seconds (filename)"]
+    for x in results:
+        lines.append(f"{x.pixels} -> {x.preprocessed_pixels}: {x.seconds:.3f}s -> {x.preprocessed_seconds:.3f}s ({x.filename})")
+    return "\n".join(lines)
+
+
+# Persistent OCR results keyed by image content and Tesseract settings
+# Each entry is a text file in the cache directory; the least recently used entries are
+# removed once the total size exceeds max_bytes
+class OcrCache:
+
+    EXTENSION = ".txt"
+
+    def __init__(self, directory, max_bytes=100 * 1024 * 1024):
+        self.directory = Tesseract.make_path_safe(directory)
+        self.max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        # Ordered from least to most recently used (modification times are used to track usage across runs)
+        self.__entries = {}
+        self.__size = 0
+        os.makedirs(self.directory, exist_ok=True)
+        existing = []
+        for name in os.listdir(self.directory):
+            if name.endswith(OcrCache.EXTENSION):
+                stat = os.stat(f"{self.directory}/{name}")
+                existing.append((stat.st_mtime, name[:-len(OcrCache.EXTENSION)], stat.st_size))
+        for _, key, size in sorted(existing):
+            self.__entries[key] = size
+            self.__size += size
+
+    def make_key(self, filename, settings_key):
+        return hashlib.sha256(f"{files.get_file_hash(filename)}|{settings_key}".encode("utf-8")).hexdigest()
+
+    def __path(self, key):
+        return f"{self.directory}/{key}{OcrCache.EXTENSION}"
+
+    def get(self, key):
+        with self.__lock:
+            if key not in self.__entries:
+                self.__misses += 1
+                return None
+            try:
+                with open(self.__path(key), "r", encoding="utf-8") as f:
+                    text = f.read()
+                os.utime(self.__path(key))
+            except FileNotFoundError as e:
+                # Removed from outside of the cache
+                self.__size -= self.__entries.pop(key)
+                self.__misses += 1
+                return None
+            self.__entries[key] = self.__entries.pop(key)
+            self.__hits += 1
+            return text
+
+    def put(self, key, text):
+        data = text.encode("utf-8")
+        with self.__lock:
+            temp_filename = f"{self.__path(key)}.{threading.get_ident()}.tmp"
+            with open(temp_filename, "wb") as f:
+                f.write(data)
+            os.replace(temp_filename, self.__path(key))
+            self.__size -= self.__entries.pop(key, 0)
+            self.__entries[key] = len(data)
+            self.__size += len(data)
+            while self.__size > self.max_bytes and len(self.__entries) > 1:
+                self.__evict()
+
+    def __evict(self):
+        key = next(iter(self.__entries))
+        self.__size -= self.__entries.pop(key)
+        self.__evictions += 1
+        try:
+            os.remove(self.__path(key))
+        except FileNotFoundError as e:
+            pass
+
+    def get_stats(self):
+        with self.__lock:
+            return OcrCacheStats(self.__hits, self.__misses, self.__evictions, len(self.__entries), self.__size)
+
+
+# Runs in the pool's worker processes (which don't run Tesseract.__init__)
+def _init_worker(tess_path):
+    if tess_path is not None:
+        pytesseract.pytesseract.tesseract_cmd = tess_path
+
+
+def _ocr_worker(tess, filename):
+    try:
+        return tess.image_to_result(filename)
+    except Exception as e:
+        return OcrResult(filename, None, f"{type(e).__name__}: {str(e)}")
+
+
 if __name__ == "__main__":
     # Usage: tesseract.py <tesseract path> <image path> [output path]
+    #        tesseract.py <tesseract path> <image directory> [output directory] [workers]
 
     if len(sys.argv) < 3:
         sys.exit(1)
@@ -50,6 +427,22 @@ if __name__ == "__main__":
         tess_path = sys.argv[1]
 
     tess = Tesseract(tess_path)
+
+    if os.path.isdir(image_filename):
+        workers = int(sys.argv[4]) if len(sys.argv) == 5 else None
+        results = tess.directory_to_results(image_filename, workers)
+        if len(sys.argv) >= 4:
+            failures = Tesseract.write_results(results, sys.argv[3])
+        else:
+            failures = []
+            for result in results:
+                if result.error is not None:
+                    print(f"{result.filename}: {result.error}", file=sys.stderr)
+                    failures.append(result)
+                else:
+                    print(f"==> {result.filename} <==\n{result.text}", file=sys.stdout)
+        sys.exit(2 if len(failures) > 0 else 0)
+
     image_text = None
     try:
         image_text = tess.image_to_string(image_filename)
@@ -62,4 +455,4 @@ if __name__ == "__main__":
             f.write(image_text)
     else:
         # Explicitly print to stdout
-        print(image_text, file=sys.stdout)
\ No newline at end of file
+        print(image_text, file=sys.stdout)